@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from itertools import islice
+
+import torch
+
+from custom_classes.custom_trainer import CustomTrainer
+from utils import MODEL_REGISTRY, TASK_REGISTRY, read_config, make_registry_entry
+from utils.model_utils import set_seed
+
+# Training throughput of data-parallel CPU training with 1 to N processes, the cores are split
+# evenly between them. Every process trains on `train_batch` examples per step, so the global
+# batch grows with the number of processes. Run from `src/`:
+#   python3 -m benchmarks.data_parallel --config-path ../configs/configs_lora/configs_mrpc_lora.py --max-processes 4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config-path", required=True, type=str)
+    parser.add_argument("--steps", default=30, type=int, help="timed training steps per process")
+    parser.add_argument("--warmup-steps", default=3, type=int)
+    parser.add_argument("--max-processes", default=os.cpu_count(), type=int)
+    parser.add_argument("--worker", action="store_true", help="internal: run as one of the launched processes")
+    return parser.parse_args()
+
+
+def worker(args):
+    make_registry_entry()
+    set_seed(42)
+    config = read_config(args.config_path)
+    train_args = config["train"]
+    task = TASK_REGISTRY[config["task"].task_name](
+        config["task"], train_args, MODEL_REGISTRY[config["task"].model])
+    trainer = CustomTrainer(task, None)
+    train_dl, _, _ = trainer.prepare_train(train_args)
+    accelerator = trainer.accelerator
+    model, optim, train_dl = accelerator.prepare(task.model, trainer.optim, train_dl)
+    model.train()
+
+    batches = islice(train_dl, args.warmup_steps + args.steps)
+    examples = torch.zeros((), device=accelerator.device)
+    for step, batch in enumerate(batches):
+        if step == args.warmup_steps:
+            accelerator.wait_for_everyone()
+            start = time.perf_counter()
+        with trainer.autocast():
+            outputs = model(**batch)
+            loss = task.loss_function(outputs, batch)
+        accelerator.backward(loss)
+        optim.step()
+        optim.zero_grad()
+        if step >= args.warmup_steps:
+            examples += batch["input_ids"].shape[0]
+    accelerator.wait_for_everyone()
+    elapsed = time.perf_counter() - start
+    examples = accelerator.reduce(examples, reduction="sum").item()
+    if accelerator.is_main_process:
+        print("RESULT " + json.dumps({"examples_per_second": examples / elapsed, "step_time": elapsed / args.steps}))
+
+
+def launch(args, num_processes):
+    # one torch thread pool per process, together using every core once
+    threads = max(1, os.cpu_count() // num_processes)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    command = [
+        sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={num_processes}",
+        "-m", "benchmarks.data_parallel", "--worker",
+        "--config-path", args.config_path, "--steps", str(args.steps), "--warmup-steps", str(args.warmup_steps),
+    ]
+    output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+    result = next(line for line in output.splitlines() if line.startswith("RESULT "))
+    return json.loads(result[len("RESULT "):])
+
+
+def main(args):
+    if args.worker:
+        return worker(args)
+    reference = None
+    num_processes = 1
+    while num_processes <= args.max_processes:
+        result = launch(args, num_processes)
+        reference = reference or result["examples_per_second"]
+        speedup = result["examples_per_second"] / reference
+        print(f"{num_processes} processes x {max(1, os.cpu_count() // num_processes)} threads: "
+              f"{result['examples_per_second']:.1f} examples/s | step time {result['step_time']:.3f}s | "
+              f"speedup {speedup:.2f} | efficiency {speedup / num_processes:.0%}")
+        num_processes *= 2
+
+
+if __name__=="__main__":
+    args = parse_args()
+    main(args)
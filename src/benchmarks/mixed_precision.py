@@ -0,0 +1,73 @@
+import time
+import argparse
+from itertools import islice
+
+import torch
+
+from custom_classes.custom_trainer import CustomTrainer
+from utils import MODEL_REGISTRY, TASK_REGISTRY, read_config, make_registry_entry
+from utils.model_utils import set_seed
+
+# Training throughput and loss parity of every `precision` mode on the same batches.
+# Run from `src/`:
+#   python3 -m benchmarks.mixed_precision --config-path ../configs/configs_lora/configs_mrpc_lora.py --steps 50
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config-path", required=True, type=str)
+    parser.add_argument("--steps", default=50, type=int, help="training steps per mode")
+    return parser.parse_args()
+
+
+def run(config, precision, bf16_frozen_weights, steps):
+    set_seed(42)
+    train_args = config["train"]
+    train_args.precision = precision
+    train_args.bf16_frozen_weights = bf16_frozen_weights
+    task = TASK_REGISTRY[config["task"].task_name](
+        config["task"], train_args, MODEL_REGISTRY[config["task"].model])
+    trainer = CustomTrainer(task, None)
+    train_dl, _, _ = trainer.prepare_train(train_args)
+    accelerator = trainer.accelerator
+    model, optim, train_dl = accelerator.prepare(task.model, trainer.optim, train_dl)
+    model.train()
+
+    losses = []
+    tokens = 0
+    start = time.perf_counter()
+    for batch in islice(train_dl, steps):
+        batch = {i: j.to(trainer.device) for i, j in batch.items()}
+        with trainer.autocast():
+            outputs = model(**batch)
+            loss = task.loss_function(outputs, batch)
+        accelerator.backward(loss)
+        optim.step()
+        optim.zero_grad()
+        losses.append(loss.item())
+        tokens += batch["attention_mask"].sum().item()
+    elapsed = time.perf_counter() - start
+    return losses, tokens / elapsed
+
+
+def main(args):
+    make_registry_entry()
+    config = read_config(args.config_path)
+    modes = [("fp32", False), ("bf16", False)]
+    if getattr(config["task"], "lora_r", None) is not None:
+        modes.append(("bf16", True))
+
+    reference = None
+    for precision, bf16_frozen_weights in modes:
+        losses, throughput = run(config, precision, bf16_frozen_weights, args.steps)
+        if reference is None:
+            reference = losses
+        diff = torch.tensor(losses) - torch.tensor(reference)
+        name = precision + (" + bf16 frozen weights" if bf16_frozen_weights else "")
+        print(f"{name}: {throughput:.0f} tokens/s | final loss {losses[-1]:.4f} | "
+              f"loss diff vs fp32 mean {diff.abs().mean():.2e} max {diff.abs().max():.2e}")
+
+
+if __name__=="__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,292 @@
+import time
+import argparse
+import collections
+from typing import Tuple
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset, load_dataset
+from transformers import AutoTokenizer
+
+from tasks.task import SQuADv2
+from utils.qa_utils import padded_logits, postprocess_qa_predictions
+
+# Parity and timing of the batched `postprocess_qa_predictions` against the previous
+# per-feature implementation, on SQuAD v2 validation features with random logits.
+# Run from `src/`:
+#   python3 -m benchmarks.qa_postprocessing --max-seq-len 384 --doc-stride 128
+# `--synthetic` only runs a small deterministic check on hand-written features, without downloads:
+#   python3 -m benchmarks.qa_postprocessing --synthetic
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", default="FacebookAI/roberta-base", type=str)
+    parser.add_argument("--max-seq-len", default=384, type=int)
+    parser.add_argument("--doc-stride", default=128, type=int)
+    parser.add_argument("--limit", default=None, type=int, help="only use the first N validation examples")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--synthetic", action="store_true", help="only run the offline check on synthetic features")
+    return parser.parse_args()
+
+
+def reference_postprocess_qa_predictions(
+    examples,
+    features,
+    predictions: Tuple[np.ndarray, np.ndarray],
+    version_2_with_negative: bool = False,
+    n_best_size: int = 20,
+    max_answer_length: int = 30,
+    null_score_diff_threshold: float = 0.0,
+):
+    # previous implementation: full argsort per feature and a python loop over n_best_size² pairs
+    if len(predictions) != 2:
+        raise ValueError("`predictions` should be a tuple with two elements (start_logits, end_logits).")
+    all_start_logits, all_end_logits = predictions
+
+    if len(predictions[0]) != len(features):
+        raise ValueError(f"Got {len(predictions[0])} predictions and {len(features)} features.")
+
+    # Build a map example to its corresponding features.
+    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
+    features_per_example = collections.defaultdict(list)
+    for i, feature in enumerate(features):
+        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+
+    # The dictionaries we have to fill.
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+
+    # Let's loop over all the examples!
+    for example_index, example in enumerate(examples):
+        # Those are the indices of the features associated to the current example.
+        feature_indices = features_per_example[example_index]
+
+        min_null_prediction = None
+        prelim_predictions = []
+
+        # Looping through all the features associated to the current example.
+        for feature_index in feature_indices:
+            # We grab the predictions of the model for this feature.
+            start_logits = all_start_logits[feature_index]
+            end_logits = all_end_logits[feature_index]
+            # This is what will allow us to map some the positions in our logits to span of texts in the original
+            # context.
+            offset_mapping = features[feature_index]["offset_mapping"]
+            # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
+            # available in the current feature.
+            token_is_max_context = features[feature_index].get("token_is_max_context", None)
+
+            # Update minimum null prediction.
+            feature_null_score = start_logits[0] + end_logits[0]
+            if min_null_prediction is None or min_null_prediction["score"] > feature_null_score:
+                min_null_prediction = {
+                    "offsets": (0, 0),
+                    "score": feature_null_score,
+                    "start_logit": start_logits[0],
+                    "end_logit": end_logits[0],
+                }
+
+            # Go through all possibilities for the `n_best_size` greater start and end logits.
+            start_indexes = np.argsort(start_logits)[-1 : -n_best_size - 1 : -1].tolist()
+            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1].tolist()
+            for start_index in start_indexes:
+                for end_index in end_indexes:
+                    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond
+                    # to part of the input_ids that are not in the context.
+                    if (
+                        start_index >= len(offset_mapping)
+                        or end_index >= len(offset_mapping)
+                        or offset_mapping[start_index] is None
+                        or len(offset_mapping[start_index]) < 2
+                        or offset_mapping[end_index] is None
+                        or len(offset_mapping[end_index]) < 2
+                    ):
+                        continue
+                    # Don't consider answers with a length that is either < 0 or > max_answer_length.
+                    if end_index < start_index or end_index - start_index + 1 > max_answer_length:
+                        continue
+                    # Don't consider answer that don't have the maximum context available (if such information is
+                    # provided).
+                    if token_is_max_context is not None and not token_is_max_context.get(str(start_index), False):
+                        continue
+
+                    prelim_predictions.append(
+                        {
+                            "offsets": (offset_mapping[start_index][0], offset_mapping[end_index][1]),
+                            "score": start_logits[start_index] + end_logits[end_index],
+                            "start_logit": start_logits[start_index],
+                            "end_logit": end_logits[end_index],
+                        }
+                    )
+        if version_2_with_negative and min_null_prediction is not None:
+            # Add the minimum null prediction
+            prelim_predictions.append(min_null_prediction)
+            null_score = min_null_prediction["score"]
+
+        # Only keep the best `n_best_size` predictions.
+        predictions = sorted(prelim_predictions, key=lambda x: x["score"], reverse=True)[:n_best_size]
+
+        # Add back the minimum null prediction if it was removed because of its low score.
+        if (
+            version_2_with_negative
+            and min_null_prediction is not None
+            and not any(p["offsets"] == (0, 0) for p in predictions)
+        ):
+            predictions.append(min_null_prediction)
+
+        # Use the offsets to gather the answer text in the original context.
+        context = example["context"]
+        for pred in predictions:
+            offsets = pred.pop("offsets")
+            pred["text"] = context[offsets[0] : offsets[1]]
+
+        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
+        # failure.
+        if len(predictions) == 0 or (len(predictions) == 1 and predictions[0]["text"] == ""):
+            predictions.insert(0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0})
+
+        # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
+        # the LogSumExp trick).
+        scores = np.array([pred.pop("score") for pred in predictions])
+        exp_scores = np.exp(scores - np.max(scores))
+        probs = exp_scores / exp_scores.sum()
+
+        # Include the probabilities in our predictions.
+        for prob, pred in zip(probs, predictions):
+            pred["probability"] = prob
+
+        # Pick the best prediction. If the null answer is not possible, this is easy.
+        if not version_2_with_negative:
+            all_predictions[example["id"]] = predictions[0]["text"]
+        else:
+            # Otherwise we first need to find the best non-empty prediction.
+            i = 0
+            while predictions[i]["text"] == "":
+                i += 1
+            best_non_null_pred = predictions[i]
+
+            # Then we compare to the null prediction using the threshold.
+            score_diff = null_score - best_non_null_pred["start_logit"] - best_non_null_pred["end_logit"]
+            scores_diff_json[example["id"]] = float(score_diff)  # To be JSON-serializable.
+            if score_diff > null_score_diff_threshold:
+                all_predictions[example["id"]] = ""
+            else:
+                all_predictions[example["id"]] = best_non_null_pred["text"]
+
+        # Make `predictions` JSON-serializable by casting np.float back to float.
+        all_nbest_json[example["id"]] = [
+            {k: (float(v) if isinstance(v, (np.float16, np.float32, np.float64)) else v) for k, v in pred.items()}
+            for pred in predictions
+        ]
+
+    return all_predictions, scores_diff_json
+
+
+def synthetic_features(example_ids, offsets):
+    # same arrow layout as `SQuADv2.process_function(..., keep_offsets=True)`, None for non-context tokens
+    flat = [pair for feature in offsets for pair in feature]
+    values = pa.array(np.array([pair or (0, 0) for pair in flat], dtype=np.int64).ravel())
+    context = pa.FixedSizeListArray.from_arrays(values, 2, mask=pa.array([pair is None for pair in flat]))
+    row_offsets = pa.array(np.r_[0, np.cumsum([len(feature) for feature in offsets])].astype(np.int32))
+    return Dataset(pa.table({
+        "example_id": pa.array(example_ids),
+        "offset_mapping": pa.ListArray.from_arrays(row_offsets, context),
+    }))
+
+
+def synthetic_check():
+    # example "a" is cut into two windows of different lengths, example "b" has no context token at all
+    examples = Dataset.from_dict({
+        "id": ["a", "b"],
+        "context": ["the cat sat on the mat", "no answer here"],
+    })
+    features = synthetic_features(
+        ["a", "a", "b"],
+        [
+            # the zero-width token (11, 11) gets the best start and end logits
+            [None, None, None, (0, 3), (4, 7), (8, 11), (11, 11), None],
+            [None, None, None, (15, 18), (19, 22)],
+            [None, None, None],
+        ],
+    )
+    start_logits = [
+        np.array([1, 0, 0, 0, 3, 0, 5, 0], dtype=np.float32),
+        np.array([0.5, 0, 0, 4, 0], dtype=np.float32),
+        np.array([2, 0, 0], dtype=np.float32),
+    ]
+    end_logits = [
+        np.array([1, 0, 0, 0, 2, 0, 5, 0], dtype=np.float32),
+        np.array([0.5, 0, 0, 0, 4.5], dtype=np.float32),
+        np.array([2, 0, 0], dtype=np.float32),
+    ]
+
+    # shorter features are padded with -inf, never with a score a position could win with
+    padded = padded_logits(start_logits, 8)
+    assert padded.shape == (3, 8) and np.isneginf(padded[1, 5:]).all() and np.isneginf(padded[2, 3:]).all()
+
+    # the empty (6, 6) span scores 10 but is skipped, "the mat" (8.5) beats "cat sat" (8) across windows
+    predictions, scores_diff = postprocess_qa_predictions(examples, features, (start_logits, end_logits))
+    assert predictions == {"a": "the mat", "b": "empty"}, predictions
+    assert scores_diff == {}, scores_diff
+    # the only difference to the reference: without version_2_with_negative it answers the empty span
+    reference, reference_diff = reference_postprocess_qa_predictions(
+        examples, features, (start_logits, end_logits))
+    assert reference == {"a": "", "b": "empty"} and reference_diff == scores_diff, reference
+
+    # null score of an example is the minimum over its windows: 1.0 - 8.5 for "a", 4.0 - 0.0 for "b"
+    predictions, scores_diff = postprocess_qa_predictions(
+        examples, features, (start_logits, end_logits), version_2_with_negative=True)
+    assert predictions == {"a": "the mat", "b": ""}, predictions
+    assert scores_diff == {"a": -7.5, "b": 4.0}, scores_diff
+    reference, reference_diff = reference_postprocess_qa_predictions(
+        examples, features, (start_logits, end_logits), version_2_with_negative=True)
+    assert reference == predictions and reference_diff == scores_diff
+    print("synthetic check passed")
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    examples = load_dataset("rajpurkar/squad_v2", split="validation")
+    if args.limit is not None:
+        examples = examples.select(range(min(args.limit, len(examples))))
+    features = examples.with_format("arrow").map(
+        lambda x: SQuADv2.process_function(x, tokenizer, args.max_seq_len, args.doc_stride, keep_offsets=True),
+        batched=True,
+        remove_columns=examples.column_names,
+    ).with_format(None)
+
+    # per-feature logits of the feature's own length, like the validation loop collects them
+    rng = np.random.default_rng(args.seed)
+    lengths = [len(ids) for ids in features["input_ids"]]
+    start_logits = [rng.normal(size=n).astype(np.float32) for n in lengths]
+    end_logits = [rng.normal(size=n).astype(np.float32) for n in lengths]
+    print(f"examples: {len(examples)} | features: {len(features)}")
+
+    for version_2_with_negative in (False, True):
+        start = time.perf_counter()
+        before, before_diff = reference_postprocess_qa_predictions(
+            examples, features, (start_logits, end_logits), version_2_with_negative=version_2_with_negative)
+        before_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        after, after_diff = postprocess_qa_predictions(
+            examples, features, (start_logits, end_logits), version_2_with_negative=version_2_with_negative)
+        after_time = time.perf_counter() - start
+
+        # without version_2_with_negative the reference may answer an empty span, see `postprocess_qa_predictions`
+        mismatches = [k for k in before if before[k] != after[k] and (version_2_with_negative or before[k] != "")]
+        assert not mismatches, f"{len(mismatches)} predictions differ, e.g. {mismatches[:5]}"
+        assert before_diff.keys() == after_diff.keys()
+        assert np.allclose(list(before_diff.values()), list(after_diff.values()), atol=1e-5), "null-score diffs differ"
+        print(f"version_2_with_negative={version_2_with_negative}: "
+              f"before {before_time:.2f}s | after {after_time:.2f}s | speedup {before_time / after_time:.1f}x")
+
+
+if __name__=="__main__":
+    args = parse_args()
+    if args.synthetic:
+        synthetic_check()
+    else:
+        main(args)
@@ -0,0 +1,121 @@
+import time
+import argparse
+
+import numpy as np
+from datasets import load_dataset
+from transformers import AutoTokenizer, DataCollatorWithPadding
+
+from tasks.task import SQuADv2
+
+# Preprocessing time and padded-token count of SQuAD v2 train, before and after the
+# vectorized `SQuADv2.process_function`. Run from `src/`:
+#   python3 -m benchmarks.squad_preprocessing --limit 20000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", default="FacebookAI/roberta-base", type=str)
+    parser.add_argument("--max-seq-len", default=384, type=int)
+    parser.add_argument("--limit", default=None, type=int, help="only use the first N training examples")
+    parser.add_argument("--batch-size", default=16, type=int, help="training batch size used to count padding")
+    return parser.parse_args()
+
+
+def reference_process_function(examples, tokenizer, max_seq_len=384):
+    # previous implementation: token-by-token loops and padding to max_length
+    questions = [q.strip() for q in examples["question"]]
+
+    inputs = tokenizer(
+        questions,
+        examples["context"],
+        max_length=max_seq_len,
+        truncation=True if max_seq_len <= 512 else "only_second",
+        return_offsets_mapping=True,
+        padding="max_length",
+    )
+
+    offset_mapping = inputs.pop("offset_mapping")
+    answers = examples["answers"]
+    start_positions = []
+    end_positions = []
+
+    for i, offset in enumerate(offset_mapping):
+        answer = answers[i]
+        if len(answer["answer_start"]) == 0:
+            start_positions.append(0)
+            end_positions.append(0)
+        else:
+            start_char = answer["answer_start"][0]
+            end_char = answer["answer_start"][0] + len(answer["text"][0])
+            sequence_ids = inputs.sequence_ids(i)
+            idx = 0
+            while sequence_ids[idx] != 1:
+                idx += 1
+            context_start = idx
+            while sequence_ids[idx] == 1:
+                idx += 1
+            context_end = idx - 1
+            # answers not fully inside the context (e.g. cut by a doc_stride window) are unanswerable
+            if offset[context_start][0] > start_char or offset[context_end][1] < end_char:
+                start_positions.append(0)
+                end_positions.append(0)
+            else:
+                idx = context_start
+                while idx <= context_end and offset[idx][0] <= start_char:
+                    idx += 1
+                start_positions.append(idx - 1)
+                idx = context_end
+                while idx >= context_start and offset[idx][1] >= end_char:
+                    idx -= 1
+                end_positions.append(idx + 1)
+
+    inputs["start_positions"] = start_positions
+    inputs["end_positions"] = end_positions
+    return inputs
+
+
+def padded_tokens(features, collator, batch_size):
+    total = 0
+    for i in range(0, len(features), batch_size):
+        batch = collator([{"input_ids": ids} for ids in features["input_ids"][i:i + batch_size]])
+        total += batch["input_ids"].numel()
+    return total
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    squad = load_dataset("rajpurkar/squad_v2", split="train")
+    if args.limit is not None:
+        squad = squad.select(range(min(args.limit, len(squad))))
+
+    start = time.perf_counter()
+    before = squad.map(
+        lambda x: reference_process_function(x, tokenizer, args.max_seq_len),
+        batched=True,
+        remove_columns=squad.column_names,
+    )
+    before_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    after = squad.with_format("arrow").map(
+        lambda x: SQuADv2.process_function(x, tokenizer, args.max_seq_len),
+        batched=True,
+        remove_columns=squad.column_names,
+    ).with_format(None)
+    after_time = time.perf_counter() - start
+
+    assert before["start_positions"] == after["start_positions"], "start positions differ"
+    assert before["end_positions"] == after["end_positions"], "end positions differ"
+    real_tokens = int(np.sum([len(ids) for ids in after["input_ids"]]))
+    before_padded = len(before) * len(before[0]["input_ids"])
+    after_padded = padded_tokens(after, DataCollatorWithPadding(tokenizer=tokenizer), args.batch_size)
+
+    print(f"examples: {len(squad)} | real tokens: {real_tokens}")
+    print(f"before: {before_time:.2f}s preprocessing | {before_padded} tokens after padding (max_length)")
+    print(f"after:  {after_time:.2f}s preprocessing | {after_padded} tokens after padding (per batch of {args.batch_size})")
+    print(f"speedup {before_time / after_time:.2f}x | padded tokens {after_padded / before_padded:.2%} of before")
+
+
+if __name__=="__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,48 @@
+import os
+import glob
+import argparse
+
+import torch
+
+from custom_classes.custom_checkpoint import model_path, save_checkpoint_files
+
+# Splits single-file `epoch_*_step_*.pt` checkpoints into a `.safetensors` model file and a
+# `.pt` file with the optimizer/scheduler state, the layout `CustomTrainer` now writes:
+#   python3 convert_checkpoints.py ../configs/configs_lora/configs_mrpc_lora
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("paths",
+                        nargs="+",
+                        help="checkpoint files or directories holding epoch_*_step_*.pt files",
+    )
+
+    return parser.parse_args()
+
+
+def checkpoint_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "epoch_*_step_*.pt")))
+        else:
+            yield path
+
+
+def main(args):
+    for path in checkpoint_files(args.paths):
+        # memory-mapped: tensors are only read while they are written out again
+        checkpoint = torch.load(path, map_location="cpu", mmap=True)
+        if 'model_state_dict' not in checkpoint:
+            print(f"{path}: already converted")
+            continue
+        size = os.path.getsize(path)
+        save_checkpoint_files(checkpoint, path, split_model=True)
+        print(f"{path}: {size / 2**20:.1f} MB -> model {os.path.getsize(model_path(path)) / 2**20:.1f} MB"
+              f" + training state {os.path.getsize(path) / 2**20:.1f} MB")
+
+
+if __name__=="__main__":
+    args = parse_args()
+    main(args)
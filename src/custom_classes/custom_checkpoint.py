@@ -0,0 +1,143 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+def snapshot(state):
+    '''Copy of a (nested) state dict with every tensor copied to CPU memory'''
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def trainable_state_dict(model):
+    '''The state_dict entries of parameters with `requires_grad`, e.g. LoRA adapters and the head'''
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    return {name: value for name, value in model.state_dict().items() if name in trainable}
+
+
+def has_frozen_parameters(model):
+    return any(not param.requires_grad for param in model.parameters())
+
+
+def model_path(path):
+    '''`epoch_0_step_10.pt` -> `epoch_0_step_10.safetensors`, where the model weights are kept'''
+    return os.path.splitext(path)[0] + ".safetensors"
+
+
+def load_model_checkpoint(path, device="cpu"):
+    '''Only the model section of a checkpoint, as {'model_state_dict', 'trainable_only'}
+
+    `path` is the training checkpoint (`.pt`) or its `.safetensors` model file. Single-file
+    checkpoints from before the split are memory-mapped, so the optimizer state they hold is
+    never read.
+    '''
+    if path.endswith(".pt") and os.path.exists(model_path(path)):
+        path = model_path(path)
+    if path.endswith(".safetensors"):
+        with safe_open(path, framework="pt", device=str(device)) as f:
+            return {
+                'model_state_dict': {name: f.get_tensor(name) for name in f.keys()},
+                'trainable_only': (f.metadata() or {}).get('trainable_only') == "True",
+            }
+    checkpoint = torch.load(path, map_location=device, mmap=True)
+    return {
+        'model_state_dict': checkpoint['model_state_dict'],
+        'trainable_only': checkpoint.get('trainable_only', False),
+    }
+
+
+def load_model_state(model, checkpoint):
+    '''Loads a full or a trainable-only `model_state_dict` into `model`
+
+    Trainable-only checkpoints hold no base weights, so `model` has to be built from the
+    same base model first (as the task does) and only the trained parameters are replaced.
+    '''
+    if not checkpoint.get('trainable_only', False):
+        model.load_state_dict(checkpoint['model_state_dict'])
+        return
+    missing, unexpected = model.load_state_dict(checkpoint['model_state_dict'], strict=False)
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    assert not unexpected and not trainable & set(missing), \
+        f"checkpoint doesn't match the model: missing {sorted(trainable & set(missing))}, unexpected {unexpected}"
+
+
+def atomic_save(state, path):
+    # readers (e.g. `load_checkpoint`) never see a half-written file
+    tmp_path = f"{path}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(obj, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint_files(state, path, split_model=True):
+    '''Writes a checkpoint, with split_model the weights go to `model_path(path)` in safetensors
+
+    The model file is renamed into place before the training state, so an existing `.pt`
+    always has a complete model file next to it.
+    '''
+    if split_model:
+        state = dict(state)
+        model_state = state.pop('model_state_dict')
+        tmp_path = f"{model_path(path)}.tmp"
+        save_file(
+            {name: value.contiguous() for name, value in model_state.items()},
+            tmp_path,
+            metadata={'trainable_only': str(state.get('trainable_only', False))},
+        )
+        os.replace(tmp_path, model_path(path))
+        state['model_file'] = os.path.basename(model_path(path))
+    atomic_save(state, path)
+
+
+class CheckpointWriter:
+    '''Writes checkpoints on a background thread
+
+    `save` snapshots the state to CPU memory, which is all the training loop waits
+    for; serialization and the disk write happen in the background. At most one
+    write is in flight, so a new `save` first waits for the previous one and only
+    one extra copy of the state is held in memory. Call `wait` before exiting.
+
+    `write_json` runs after the writes submitted before it, so a file pointing to a
+    checkpoint (e.g. `best_checkpoint.json`) never refers to one that isn't on disk yet.
+    '''
+
+    def __init__(self, asynchronous=True, split_model=True):
+        self.asynchronous = asynchronous
+        self.split_model = split_model
+        self.executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self.pending = []
+
+    def save(self, state, path):
+        self.wait()
+        if not self.asynchronous:
+            save_checkpoint_files(state, path, self.split_model)
+            return
+        self.pending.append(self.executor.submit(save_checkpoint_files, snapshot(state), path, self.split_model))
+
+    def write_json(self, obj, path):
+        if not self.asynchronous:
+            atomic_write_json(obj, path)
+            return
+        # the single worker runs writes in submission order
+        self.pending.append(self.executor.submit(atomic_write_json, obj, path))
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            # re-raises a failed write here
+            future.result()
@@ -0,0 +1,200 @@
+import os
+import json
+import random
+import shutil
+from itertools import chain
+
+import numpy as np
+import pyarrow as pa
+
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+
+class StreamingDataset(IterableDataset):
+    '''Tokenizes a streamed (`datasets` iterable, arrow-formatted) split on the fly
+
+    Raw examples are read in chunks of `chunk_size` and every DataLoader worker
+    tokenizes every `num_workers`-th chunk, so workers split the tokenization
+    work between them. With `shuffle_buffer`, examples are drawn at random from
+    a buffer of that many examples, so memory stays flat regardless of the split
+    size. `length` (number of examples) is only a hint for `len(dataloader)`,
+    which the LR schedulers need.
+    '''
+
+    def __init__(self, dataset, process_function, columns, length=None, shuffle_buffer=0, chunk_size=1000, seed=42):
+        self.dataset = dataset
+        self.process_function = process_function
+        self.columns = columns
+        self.length = length
+        self.shuffle_buffer = shuffle_buffer
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError("length of the streamed split is unknown")
+        return self.length
+
+    def examples(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # `iter` reads the raw split without datasets' own per-worker shard split
+        for i, chunk in enumerate(self.dataset.iter(batch_size=self.chunk_size)):
+            if i % num_workers != worker_id:
+                continue
+            yield from self.process_function(chunk).select(self.columns).to_pylist()
+
+    def __iter__(self):
+        if not self.shuffle_buffer:
+            yield from self.examples()
+            return
+
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        rng = random.Random(self.seed + 1000 * self.epoch + worker_id)
+        # persistent workers keep their copy, so the epoch also advances here
+        self.epoch += 1
+
+        buffer = []
+        for example in self.examples():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class TokenStore(Dataset):
+    '''Tokenized split packed into flat arrays, memory-mapped from disk
+
+    Every token column (`input_ids`, ...) is a single int32 array holding the
+    tokens of all examples back to back, sliced by a shared `offsets` array;
+    every scalar column (labels, answer positions) is one array. `__getitems__`
+    gathers a whole batch straight into padded tensors with an attention mask,
+    so the DataLoader takes `TokenStore.collate` instead of
+    `DataCollatorWithPadding`.
+    '''
+
+    def __init__(self, offsets, token_columns, scalar_columns, pad_values=None, padding_side="right", path=None):
+        self.offsets = offsets
+        self.token_columns = token_columns
+        self.scalar_columns = scalar_columns
+        self.pad_values = pad_values or {}
+        self.padding_side = padding_side
+        self.path = path
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        table = dataset.with_format("arrow")[:]
+        offsets = None
+        token_columns = {}
+        scalar_columns = {}
+        for name in table.column_names:
+            column = table.column(name).combine_chunks()
+            if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+                column_offsets = column.offsets.to_numpy().astype(np.int64)
+                values = column.values.to_numpy(zero_copy_only=False)
+                token_columns[name] = values[column_offsets[0]:column_offsets[-1]].astype(np.int32)
+                column_offsets -= column_offsets[0]
+                assert offsets is None or np.array_equal(offsets, column_offsets), \
+                    f"token column {name} isn't aligned with the other token columns!"
+                offsets = column_offsets
+            else:
+                scalar_columns[name] = column.to_numpy(zero_copy_only=False)
+        assert offsets is not None, "a token store needs at least one token column!"
+        return cls(offsets, token_columns, scalar_columns, **kwargs)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "offsets.npy"), self.offsets)
+        for name, values in chain(self.token_columns.items(), self.scalar_columns.items()):
+            np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+        with open(os.path.join(tmp_path, "columns.json"), "w") as f:
+            json.dump({"token_columns": list(self.token_columns), "scalar_columns": list(self.scalar_columns)}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same store first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(os.path.join(path, "columns.json")) as f:
+            columns = json.load(f)
+
+        def mmap(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        return cls(
+            mmap("offsets"),
+            {name: mmap(name) for name in columns["token_columns"]},
+            {name: mmap(name) for name in columns["scalar_columns"]},
+            path=path,
+            **kwargs,
+        )
+
+    def __getstate__(self):
+        # workers started with spawn re-open the memory maps instead of receiving copies
+        state = dict(self.__dict__)
+        if self.path is not None:
+            for name in ("offsets", "token_columns", "scalar_columns"):
+                state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        if "offsets" not in state:
+            state = dict(vars(self.load(state["path"])), **state)
+        self.__dict__.update(state)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        example = {name: values[start:end].tolist() for name, values in self.token_columns.items()}
+        example.update({name: values[index].item() for name, values in self.scalar_columns.items()})
+        return example
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        mask = np.arange(lengths.max()) < lengths[:, None]
+        if self.padding_side == "left":
+            mask = mask[:, ::-1]
+        # position in the flat arrays of every token of the batch, row by row
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1]) + np.repeat(starts - (ends - lengths), lengths)
+
+        batch = {}
+        for name, values in self.token_columns.items():
+            padded = torch.full(mask.shape, self.pad_values.get(name, 0), dtype=torch.long)
+            padded.numpy()[mask] = values[positions]
+            batch[name] = padded
+        if "attention_mask" not in batch:
+            batch["attention_mask"] = torch.from_numpy(mask.astype(np.int64))
+        for name, values in self.scalar_columns.items():
+            values = np.asarray(values[indices])
+            if np.issubdtype(values.dtype, np.floating):
+                values = values.astype(np.float32)
+            # same renaming as DataCollatorWithPadding
+            batch["labels" if name in ("label", "label_ids") else name] = torch.from_numpy(values)
+        return batch
+
+    @staticmethod
+    def collate(batch):
+        # `__getitems__` already returns the padded batch
+        return batch
@@ -1,6 +1,11 @@
 from tqdm import tqdm
 
 import torch
+from torch.utils.data import IterableDataset
+
+from custom_classes.custom_checkpoint import load_model_checkpoint, load_model_state
+from custom_classes.custom_inference import precision_autocast, predict_sharded, save_predictions
+from custom_classes.custom_sampler import restore_order
 
 class FakeWandB:
 
@@ -20,8 +25,10 @@ class CustomEvaluator:
         test_dl = self.task.prepare_eval()        
         self.task.model = self.task.model.to(self.device)
         if not args.from_hf:
-            checkpoint = torch.load(args.checkpoint, map_location=self.device)
-            self.task.model.load_state_dict(checkpoint['model_state_dict'])
+            # only the model weights are read, never the optimizer state
+            checkpoint = load_model_checkpoint(args.checkpoint, self.device)
+            # trainable-only (LoRA) checkpoints are applied on top of the base weights the task loaded
+            load_model_state(self.task.model, checkpoint)
         return test_dl
 
     def evaluate(self, args):
@@ -31,22 +38,53 @@ class CustomEvaluator:
         self.task.print_model_params()
         model = self.task.model.to(self.device)
         # ========== evaluation ==========
-        preds = []
-        labels = []
-        with torch.no_grad():
-            for step, batch in enumerate(tqdm(test_dl)):
-                # ========== forward pass ==========
-                batch = {i:j.to(self.device) for i,j in batch.items()}
-                outputs = model(**batch)
-
-                # ========== compute metric ==========
-                preds.extend(
-                    self.task.extract_answer_from_output(outputs)
-                )
-                labels.extend(
-                    self.task.extract_label_from_input(batch)
-                )
+        # eval_processes: CPU processes sharing the test batches, see `predict_sharded`
+        num_processes = getattr(args, "eval_processes", 1)
+        # precision: "fp32" | "bf16" autocast, as in training
+        precision = getattr(args, "precision", "fp32")
+        batch_idx = []
+        if num_processes > 1 and self.device == "cpu" and not isinstance(test_dl.dataset, IterableDataset):
+            preds, labels = predict_sharded(
+                model,
+                test_dl,
+                self.task.extract_answer_from_output,
+                self.task.extract_label_from_input,
+                num_processes,
+                precision=precision,
+            )
+        else:
+            preds = []
+            labels = []
+            with torch.inference_mode():
+                for step, batch in enumerate(tqdm(test_dl)):
+                    if "idx" in batch:
+                        # see `custom_inference.predict`
+                        batch_idx.extend(batch.pop("idx").tolist())
+                    # ========== forward pass ==========
+                    batch = {i:j.to(self.device) for i,j in batch.items()}
+                    with precision_autocast(precision, self.device):
+                        outputs = model(**batch)
+
+                    # ========== compute metric ==========
+                    preds.extend(
+                        self.task.extract_answer_from_output(outputs)
+                    )
+                    if "labels" in batch:
+                        labels.extend(
+                            self.task.extract_label_from_input(batch)
+                        )
+        # back to dataset order, whatever the sampler and the number of processes
+        preds = restore_order(test_dl, preds)
+        labels = restore_order(test_dl, labels) if labels else labels
+
+        # prediction_file: also write the predictions keyed by `idx`, like `CustomTrainer.evaluate`
+        prediction_file = getattr(args, "prediction_file", None)
+        if prediction_file is not None:
+            save_predictions(preds, batch_idx or self.task.test_idx, prediction_file)
 
+        # test splits without labels (e.g. GLUE) only produce the prediction file
+        if not labels:
+            return None
         val_result = self.task.compute_metric(preds, labels)
         print("Test set acc: {}".format(val_result))
         return val_result
@@ -0,0 +1,161 @@
+import os
+import copy
+import json
+import contextlib
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from custom_classes.custom_sampler import restore_order
+
+
+def predict(model, test_dl, extract_answer, autocast=contextlib.nullcontext, prepare_batch=None, progress=True):
+    '''Predictions for `test_dl` in dataset order, and the `idx` of streamed test sets'''
+    preds = []
+    batch_idx = []
+    model.eval()
+    with torch.inference_mode():
+        for batch in tqdm(test_dl, disable=not progress):
+            if prepare_batch is not None:
+                batch = prepare_batch(batch)
+            batch.pop("labels", None)
+            if "idx" in batch:
+                # streamed test sets carry their idx instead of `task.test_idx`
+                batch_idx.extend(batch.pop("idx").tolist())
+            with autocast():
+                outputs = model(**batch)
+            preds.extend(extract_answer(outputs))
+    return restore_order(test_dl, preds), batch_idx
+
+
+def save_predictions(preds, test_idx, output_file):
+    assert len(test_idx) == len(
+        preds), "test idx number and prediction number doesn't match!"
+    results = dict()
+    for idx, pred in zip(test_idx, preds):
+        results[int(idx)] = pred
+    print(f"Saving inference results @ {output_file}")
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp_file, output_file)
+
+
+def weight_snapshot(model):
+    '''CPU copy of `model` in eval mode with its tensors in shared memory, for another process'''
+    snapshot = copy.deepcopy(model).to("cpu").eval()
+    # a compiled model's forward is bound to the original module, the copy runs eagerly
+    snapshot.__dict__.pop("_compiled_call_impl", None)
+    return snapshot.share_memory()
+
+
+def precision_autocast(precision, device_type="cpu"):
+    '''Autocast context of a `precision` setting ("fp32" | "bf16"), like `CustomTrainer.autocast`'''
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+def inference_worker(model, test_dl, extract_answer, test_idx, output_file, precision, num_threads):
+    torch.set_num_threads(num_threads)
+    autocast = lambda: precision_autocast(precision)
+    preds, batch_idx = predict(model, test_dl, extract_answer, autocast, progress=False)
+    save_predictions(preds, batch_idx or test_idx, output_file)
+
+
+class BackgroundInference:
+    '''Writes test set predictions from a separate process, so training doesn't wait for them
+
+    `submit` copies the weights to shared memory and starts a process that runs the
+    test set on the CPU with `num_threads` threads while training goes on. At most one
+    job runs at a time: a new `submit` first waits for the previous one, so only one
+    extra copy of the weights is held in memory. Call `wait` before exiting.
+    '''
+
+    def __init__(self, num_threads=1):
+        self.num_threads = num_threads
+        # spawned, see `predict_sharded`
+        self.context = mp.get_context("spawn")
+        self.pending = None
+
+    def submit(self, model, test_dl, extract_answer, test_idx, output_file, precision="fp32"):
+        self.wait()
+        snapshot = weight_snapshot(model)
+        # the seeded generator of the loader can't be sent to another process, test batches aren't shuffled
+        test_dl = copy.copy(test_dl)
+        test_dl.generator = None
+        process = self.context.Process(
+            target=inference_worker,
+            args=(snapshot, test_dl, extract_answer, test_idx, output_file, precision, self.num_threads),
+        )
+        process.start()
+        # the child maps the shared weights after `start` returns, they have to stay alive until then
+        self.pending = (process, output_file, snapshot)
+
+    def wait(self):
+        if self.pending is None:
+            return
+        (process, output_file, _), self.pending = self.pending, None
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"test inference for {output_file} failed with exit code {process.exitcode}")
+
+
+# set in every worker of `predict_sharded` by `init_shard_worker`
+_shard_worker = {}
+
+
+def init_shard_worker(model, dataset, collate_fn, extract_answer, extract_label, num_threads, precision):
+    torch.set_num_threads(num_threads)
+    _shard_worker.update(
+        model=model.eval(),
+        dataset=dataset,
+        collate_fn=collate_fn,
+        extract_answer=extract_answer,
+        extract_label=extract_label,
+        precision=precision,
+    )
+
+
+def predict_shard(batches):
+    preds = []
+    labels = []
+    dataloader = DataLoader(_shard_worker["dataset"], batch_sampler=batches, collate_fn=_shard_worker["collate_fn"])
+    with torch.inference_mode():
+        for batch in dataloader:
+            with precision_autocast(_shard_worker["precision"]):
+                outputs = _shard_worker["model"](**batch)
+            preds.extend(_shard_worker["extract_answer"](outputs))
+            if "labels" in batch:
+                labels.extend(_shard_worker["extract_label"](batch))
+    return preds, labels
+
+
+def predict_sharded(model, test_dl, extract_answer, extract_label, num_processes, batches_per_shard=8,
+                    precision="fp32"):
+    '''Predictions and labels for `test_dl` from `num_processes` CPU processes, in the loader's batch order
+
+    The weights are moved to shared memory once and every process receives them, and the
+    dataset, once when it starts. The batches of `test_dl` are cut into shards of
+    `batches_per_shard` consecutive batches, which the processes pick up as they finish
+    (sorted loaders put the longest batches first); the results are put back in batch
+    order, so they are the same as iterating over `test_dl` in one process.
+    '''
+    batches = [list(batch) for batch in test_dl.batch_sampler]
+    shards = [batches[i:i + batches_per_shard] for i in range(0, len(batches), batches_per_shard)]
+    model = model.to("cpu").share_memory()
+    # spawn: a forked child could inherit locked OpenMP / tokenizer thread pools
+    context = mp.get_context("spawn")
+    preds = []
+    labels = []
+    with context.Pool(
+        num_processes,
+        initializer=init_shard_worker,
+        initargs=(model, test_dl.dataset, test_dl.collate_fn, extract_answer, extract_label,
+                  max(1, torch.get_num_threads() // num_processes), precision),
+    ) as pool:
+        # imap returns the shards in order
+        for shard_preds, shard_labels in tqdm(pool.imap(predict_shard, shards), total=len(shards)):
+            preds.extend(shard_preds)
+            labels.extend(shard_labels)
+    return preds, labels
@@ -0,0 +1,224 @@
+import numpy as np
+import pyarrow.compute as pc
+
+import torch
+from torch.utils.data import Sampler
+
+
+def sequence_lengths(dataset, column="input_ids"):
+    '''Token count of every example, read straight from the arrow column'''
+    return pc.list_value_length(dataset.with_format("arrow")[column]).to_numpy()
+
+
+class BucketBatchSampler(Sampler):
+    '''Batches examples of similar length while keeping the epoch order random
+
+    Every epoch the dataset is shuffled and split into pools of
+    `batch_size * bucket_size_multiplier` examples. Each pool is sorted by length
+    and cut into batches, and the batches of all pools are shuffled again, so
+    padding inside a batch stays small without a fixed short-to-long curriculum.
+    '''
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, shuffle=True, drop_last=False, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def resume(self, batches_done):
+        # the next iteration starts right after the first `batches_done` batches of its epoch;
+        # the batch order only depends on seed and epoch, so nothing before has to be loaded
+        self.skip = batches_done
+
+    def state_dict(self):
+        # what determines the batch order of an epoch
+        return {"seed": self.seed, "batch_size": self.batch_size, "bucket_size": self.bucket_size}
+
+    def _generator(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return generator
+
+    def batches(self):
+        generator = self._generator()
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths), generator=generator).numpy()
+        else:
+            order = np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            pool = order[start:start + self.bucket_size]
+            # stable sort keeps the shuffled order among equal lengths
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches.extend(self.split_pool(pool))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def split_pool(self, pool):
+        batches = []
+        for i in range(0, len(pool), self.batch_size):
+            batch = pool[i:i + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            batches.append(batch.tolist())
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()[self.skip:]
+        self.skip = 0
+        self.epoch += 1
+        yield from batches
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        # every pool but the last is a multiple of batch_size
+        full_pools, remainder = divmod(len(self.lengths), self.bucket_size)
+        return full_pools * (self.bucket_size // self.batch_size) + -(-remainder // self.batch_size)
+
+    def total_batches(self, epochs):
+        return len(self) * epochs
+
+
+class RandomBatchSampler(BucketBatchSampler):
+    '''Uniformly shuffled batches, the default training order, seeded so it can be resumed'''
+
+    def __init__(self, num_examples, batch_size, drop_last=False, seed=42):
+        super().__init__(
+            np.zeros(num_examples, dtype=np.int64),
+            batch_size,
+            bucket_size_multiplier=1,
+            drop_last=drop_last,
+            seed=seed,
+        )
+
+    def batches(self):
+        order = torch.randperm(len(self.lengths), generator=self._generator()).numpy()
+        return self.split_pool(order)
+
+
+def pack_by_tokens(indices, lengths, max_tokens, max_batch_size=None):
+    '''Greedily cut length-sorted `indices` into batches whose padded size fits `max_tokens`
+
+    An example longer than the budget on its own still gets a batch of size one.
+    '''
+    batches = []
+    batch = []
+    batch_max_len = 0
+    for index in indices.tolist():
+        length = int(lengths[index])
+        new_max_len = max(batch_max_len, length)
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or new_max_len * (len(batch) + 1) > max_tokens):
+            batches.append(batch)
+            batch = []
+            new_max_len = length
+        batch.append(index)
+        batch_max_len = new_max_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    '''Variable-size batches holding at most `max_tokens` tokens after padding
+
+    Uses the same shuffled, length-sorted pools as `BucketBatchSampler`; pools hold
+    roughly `bucket_size_multiplier` batches of median-length examples. The number
+    of batches depends on the shuffle, so `__len__` is the exact count for the
+    upcoming epoch and `total_batches` sums the exact counts over several epochs.
+    '''
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, bucket_size_multiplier=100, shuffle=True, seed=42):
+        lengths = np.asarray(lengths)
+        approx_batch_size = max(1, max_tokens // max(1, int(np.median(lengths))))
+        super().__init__(
+            lengths,
+            batch_size=approx_batch_size,
+            bucket_size_multiplier=bucket_size_multiplier,
+            shuffle=shuffle,
+            seed=seed,
+        )
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self._num_batches = {}
+        # batches vary in size, accelerate shards them as such across processes when this is None
+        self.batch_size = None
+
+    def state_dict(self):
+        return {"seed": self.seed, "max_tokens": self.max_tokens, "bucket_size": self.bucket_size}
+
+    def split_pool(self, pool):
+        return pack_by_tokens(pool, self.lengths, self.max_tokens, self.max_batch_size)
+
+    def num_batches(self, epoch):
+        if epoch not in self._num_batches:
+            current_epoch = self.epoch
+            self.epoch = epoch
+            self._num_batches[epoch] = len(self.batches())
+            self.epoch = current_epoch
+        return self._num_batches[epoch]
+
+    def __len__(self):
+        return self.num_batches(self.epoch)
+
+    def total_batches(self, epochs):
+        return sum(self.num_batches(self.epoch + epoch) for epoch in range(epochs))
+
+
+class SortedBatchSampler(Sampler):
+    '''Deterministic longest-first batching for validation and test sets
+
+    With `max_tokens`, batches are packed under a padded-token budget and
+    `batch_size` (if not None) only caps the number of examples per batch.
+    Predictions come out in sorted order; `restore_order` puts them back in
+    dataset order so they line up with e.g. `task.test_idx`.
+    '''
+
+    def __init__(self, lengths, batch_size, max_tokens=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.order = np.argsort(-self.lengths, kind="stable")
+        if max_tokens is None:
+            self._batches = [
+                self.order[i:i + batch_size].tolist() for i in range(0, len(self.order), batch_size)
+            ]
+        else:
+            self._batches = pack_by_tokens(self.order, self.lengths, max_tokens, batch_size)
+            # packed batches vary in size; with a batch_size, accelerate's `gather_for_metrics` would cut
+            # the last batch down to `len(dataset) % batch_size` examples
+            self.batch_size = None
+
+    def __iter__(self):
+        yield from self._batches
+
+    def __len__(self):
+        return len(self._batches)
+
+    def restore_order(self, values):
+        assert len(values) == len(self.order), "number of values doesn't match the number of examples!"
+        restored = [None] * len(values)
+        for position, value in zip(self.order.tolist(), values):
+            restored[position] = value
+        return restored
+
+
+def restore_order(dataloader, values):
+    '''Undo the reordering of an order-changing batch sampler, if any'''
+    batch_sampler = getattr(dataloader, "batch_sampler", None)
+    # a loader prepared by accelerate for several processes shards the batches of the original sampler,
+    # `gather_for_metrics` puts them back into its order
+    batch_sampler = getattr(batch_sampler, "batch_sampler", batch_sampler)
+    if hasattr(batch_sampler, "restore_order"):
+        return batch_sampler.restore_order(values)
+    return values
@@ -0,0 +1,446 @@
+import json
+import math
+import time
+import random
+import sqlite3
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import torch
+
+from utils.data_utils import available_cores
+
+
+class SearchSpace:
+    '''The `parameters` of a wandb sweep configuration
+
+    Supported per parameter: {"value": v}, {"values": [...]} and {"min", "max"} with an
+    optional "distribution" of "uniform", "int_uniform" or "log_uniform_values" (without
+    one, int bounds give int_uniform). Every parameter is encoded to [0, 1] for the
+    Bayesian search: numeric `values` by their rank, other `values` one-hot.
+    '''
+    distributions = ["uniform", "int_uniform", "log_uniform_values"]
+
+    def __init__(self, parameters):
+        self.parameters = {}
+        for name, spec in parameters.items():
+            if "value" in spec:
+                spec = {"values": [spec["value"]]}
+            if "values" in spec:
+                values = list(spec["values"])
+                numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)
+                self.parameters[name] = {"values": sorted(values) if numeric else values, "numeric": numeric}
+                continue
+            if "min" not in spec or "max" not in spec:
+                raise ValueError(f"sweep parameter {name} needs `value`, `values` or `min` and `max`")
+            default = "int_uniform" if isinstance(spec["min"], int) and isinstance(spec["max"], int) else "uniform"
+            distribution = spec.get("distribution", default)
+            if distribution not in self.distributions:
+                raise ValueError(f"sweep parameter {name}: distribution {distribution} is not one of {self.distributions}")
+            self.parameters[name] = {"min": spec["min"], "max": spec["max"], "distribution": distribution}
+
+    @property
+    def discrete(self):
+        return all("values" in p for p in self.parameters.values())
+
+    def grid(self):
+        if not self.discrete:
+            raise ValueError("grid search needs `values` for every parameter")
+        names = list(self.parameters)
+        for values in itertools.product(*(self.parameters[n]["values"] for n in names)):
+            yield dict(zip(names, values))
+
+    def sample(self, rng):
+        params = {}
+        for name, p in self.parameters.items():
+            if "values" in p:
+                params[name] = rng.choice(p["values"])
+            elif p["distribution"] == "int_uniform":
+                params[name] = rng.randint(p["min"], p["max"])
+            elif p["distribution"] == "log_uniform_values":
+                params[name] = math.exp(rng.uniform(math.log(p["min"]), math.log(p["max"])))
+            else:
+                params[name] = rng.uniform(p["min"], p["max"])
+        return params
+
+    def encode(self, params):
+        x = []
+        for name, p in self.parameters.items():
+            value = params[name]
+            if "values" in p:
+                position = p["values"].index(value)
+                if p["numeric"]:
+                    x.append(position / max(1, len(p["values"]) - 1))
+                else:
+                    x.extend(float(i == position) for i in range(len(p["values"])))
+            elif p["distribution"] == "log_uniform_values":
+                x.append((math.log(value) - math.log(p["min"])) / (math.log(p["max"]) - math.log(p["min"])))
+            else:
+                x.append((value - p["min"]) / (p["max"] - p["min"]))
+        return np.array(x, dtype=np.float64)
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class GridSearch:
+
+    def __init__(self, space, seed=42):
+        self.space = space
+
+    def suggest(self, observations, pending):
+        tried = {params_key(params) for params, _ in observations} | {params_key(params) for params in pending}
+        return next((params for params in self.space.grid() if params_key(params) not in tried), None)
+
+
+class RandomSearch:
+
+    def __init__(self, space, seed=42):
+        self.space = space
+        self.rng = random.Random(seed)
+
+    def suggest(self, observations, pending):
+        return self.space.sample(self.rng)
+
+
+def normal_cdf(z):
+    return 0.5 * np.vectorize(math.erfc)(-z / math.sqrt(2))
+
+
+def normal_pdf(z):
+    return np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+
+
+class BayesSearch:
+    '''Gaussian process (RBF kernel) with expected improvement, over the encoded parameters
+
+    The first `initial_trials` suggestions are random. The kernel length scale is picked by
+    marginal likelihood from a few candidates. Trials still running count as observations
+    of the worst value so far ("constant liar"), which keeps concurrent suggestions apart.
+    Discrete spaces never suggest a configuration twice.
+    '''
+    length_scales = [0.05, 0.1, 0.2, 0.5, 1.0]
+
+    def __init__(self, space, seed=42, initial_trials=4, candidates=2000, noise=1e-4):
+        self.space = space
+        self.rng = random.Random(seed)
+        self.initial_trials = initial_trials
+        self.candidates = candidates
+        self.noise = noise
+
+    def kernel(self, a, b, length_scale):
+        distances = ((a[:, None, :] - b[None, :, :]) ** 2).sum(-1)
+        return np.exp(-0.5 * distances / length_scale ** 2)
+
+    def fit(self, x, y):
+        best = None
+        for length_scale in self.length_scales:
+            k = self.kernel(x, x, length_scale) + self.noise * np.eye(len(x))
+            chol = np.linalg.cholesky(k)
+            alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, y))
+            log_likelihood = -0.5 * y @ alpha - np.log(np.diag(chol)).sum()
+            if best is None or log_likelihood > best[0]:
+                best = (log_likelihood, length_scale, chol, alpha)
+        return best[1:]
+
+    def suggest(self, observations, pending):
+        tried = {params_key(params) for params, _ in observations} | {params_key(params) for params in pending}
+        candidates = [self.space.sample(self.rng) for _ in range(self.candidates)]
+        if self.space.discrete:
+            candidates = list({params_key(c): c for c in candidates if params_key(c) not in tried}.values())
+            if not candidates:
+                candidates = [c for c in self.space.grid() if params_key(c) not in tried]
+            if not candidates:
+                return None
+        if len(observations) < self.initial_trials:
+            return candidates[0]
+
+        # maximized: `values` are already signed by the metric goal
+        values = np.array([value for _, value in observations], dtype=np.float64)
+        values = np.concatenate([values, np.full(len(pending), values.min())])
+        mean, std = values.mean(), values.std() or 1.0
+        y = (values - mean) / std
+        x = np.stack([self.space.encode(params) for params, _ in observations] +
+                     [self.space.encode(params) for params in pending])
+        length_scale, chol, alpha = self.fit(x, y)
+
+        candidate_x = np.stack([self.space.encode(c) for c in candidates])
+        k = self.kernel(candidate_x, x, length_scale)
+        mu = k @ alpha
+        v = np.linalg.solve(chol, k.T)
+        sigma = np.sqrt(np.clip(1.0 + self.noise - (v ** 2).sum(0), 1e-12, None))
+        z = (mu - y.max()) / sigma
+        expected_improvement = (mu - y.max()) * normal_cdf(z) + sigma * normal_pdf(z)
+        return candidates[int(np.argmax(expected_improvement))]
+
+
+SEARCH_METHODS = {
+    "grid": GridSearch,
+    "random": RandomSearch,
+    "bayes": BayesSearch,
+}
+
+
+class SuccessiveHalving:
+    '''Asynchronous successive halving (ASHA) of the trials of a sweep
+
+    Rungs are at `min_iter`, `min_iter * eta`, `min_iter * eta ** 2`, ... values of the sweep
+    metric logged by a trial (one per validation), below `max_iter` if given. A trial
+    reaching a rung continues to the next one only when its value is in the best `1 / eta`
+    of the values other trials had at that rung before it; the first trial at a rung always
+    continues. Decisions never wait for other trials, so no worker sits idle.
+    '''
+
+    def __init__(self, min_iter=1, eta=3, max_iter=None):
+        self.min_iter = min_iter
+        self.eta = eta
+        self.max_iter = max_iter
+
+    def rung(self, iteration):
+        if self.max_iter is not None and iteration >= self.max_iter:
+            return None
+        rung, milestone = 0, self.min_iter
+        while milestone < iteration:
+            rung, milestone = rung + 1, milestone * self.eta
+        return rung if milestone == iteration else None
+
+    def keeps(self, value, recorded):
+        # values are signed by the metric goal, larger is better
+        if not recorded:
+            return True
+        return value >= np.quantile(recorded, 1 - 1 / self.eta)
+
+
+# early_terminate types of a sweep configuration, wandb names ASHA "hyperband"
+EARLY_TERMINATION = {
+    "hyperband": SuccessiveHalving,
+    "asha": SuccessiveHalving,
+}
+
+
+class SweepStore:
+    '''Trials and their logged metrics in a SQLite file, shared by the sweep and its workers
+
+    Every call opens its own connection, so the store can be handed to other processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS trials (id INTEGER PRIMARY KEY, sweep TEXT, params TEXT, "
+                "status TEXT, value REAL, started REAL, finished REAL, error TEXT)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS metrics (trial INTEGER, step INTEGER, name TEXT, value REAL, "
+                "PRIMARY KEY (trial, name, step))")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rungs (sweep TEXT, rung INTEGER, trial INTEGER, value REAL, "
+                "PRIMARY KEY (sweep, rung, trial))")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add_trial(self, sweep, params):
+        with self.connect() as db:
+            return db.execute(
+                "INSERT INTO trials (sweep, params, status, started) VALUES (?, ?, 'running', ?)",
+                (sweep, params_key(params), time.time()),
+            ).lastrowid
+
+    def finish_trial(self, trial_id, value, status="finished"):
+        with self.connect() as db:
+            db.execute("UPDATE trials SET status = ?, value = ?, finished = ? WHERE id = ?",
+                       (status, value, time.time(), trial_id))
+
+    def fail_trial(self, trial_id, error):
+        with self.connect() as db:
+            db.execute("UPDATE trials SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                       (error, time.time(), trial_id))
+
+    def interrupt_running(self, sweep):
+        # trials left running by a sweep that was killed
+        with self.connect() as db:
+            db.execute("UPDATE trials SET status = 'failed', error = 'interrupted' WHERE sweep = ? AND status = 'running'",
+                       (sweep,))
+
+    def trials(self, sweep, status=None):
+        query = "SELECT id, params, status, value FROM trials WHERE sweep = ?"
+        arguments = (sweep,)
+        if status is not None:
+            statuses = [status] if isinstance(status, str) else list(status)
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            arguments += tuple(statuses)
+        with self.connect() as db:
+            rows = db.execute(query + " ORDER BY id", arguments).fetchall()
+        return [{"id": i, "params": json.loads(p), "status": s, "value": v} for i, p, s, v in rows]
+
+    def log_metric(self, trial_id, step, name, value):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)", (trial_id, step, name, value))
+
+    def record_rung(self, sweep, rung, trial_id, value):
+        '''Adds the value of a trial at a rung, returns the values other trials had there before'''
+        with self.connect() as db:
+            # one writer at a time, so two trials reaching a rung together see each other in order
+            db.execute("BEGIN IMMEDIATE")
+            recorded = [v for v, in db.execute(
+                "SELECT value FROM rungs WHERE sweep = ? AND rung = ? AND trial != ?", (sweep, rung, trial_id))]
+            db.execute("INSERT OR REPLACE INTO rungs VALUES (?, ?, ?, ?)", (sweep, rung, trial_id, value))
+        return recorded
+
+    def metrics(self, trial_id, name):
+        with self.connect() as db:
+            return [value for value, in db.execute(
+                "SELECT value FROM metrics WHERE trial = ? AND name = ? ORDER BY step", (trial_id, name))]
+
+
+class Trial:
+    '''What a trial function gets: its id and params, and `log`, which stands in for `wandb.log`
+
+    Every logged number is stored in the sweep database under the number of times that
+    metric was logged before. With an early termination `scheduler`, logging the sweep
+    metric at a rung sets `should_stop` for trials that lost; the trial function (e.g.
+    `CustomTrainer.train`) checks it after every validation and returns.
+    '''
+
+    def __init__(self, trial_id, params, store, sweep=None, metric=None, sign=1.0, scheduler=None):
+        self.id = trial_id
+        self.params = params
+        self.store = store
+        self.sweep = sweep
+        self.metric = metric
+        self.sign = sign
+        self.scheduler = scheduler
+        self.steps = {}
+        self.summary = {}
+        self.should_stop = False
+
+    def log(self, logs):
+        for name, value in logs.items():
+            if isinstance(value, torch.Tensor):
+                value = value.item()
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            step = self.steps.get(name, 0)
+            self.steps[name] = step + 1
+            self.summary[name] = value
+            self.store.log_metric(self.id, step, name, value)
+            if name == self.metric and self.scheduler is not None:
+                self.report(step + 1, value)
+
+    def report(self, iteration, value):
+        rung = self.scheduler.rung(iteration)
+        if rung is None:
+            return
+        value = self.sign * value
+        recorded = self.store.record_rung(self.sweep, rung, self.id, value)
+        if not self.scheduler.keeps(value, recorded):
+            print(f"Trial {self.id} stopped at rung {rung} ({iteration} validations)")
+            self.should_stop = True
+
+
+def init_trial_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def run_trial(trial_fn, trial):
+    trial_fn(trial.params, trial)
+    if trial.metric not in trial.summary:
+        raise RuntimeError(f"trial {trial.id} never logged the sweep metric {trial.metric}")
+    # like wandb, the metric of a trial is the last value it logged
+    return trial.summary[trial.metric], trial.should_stop
+
+
+class LocalSweep:
+    '''Runs a wandb sweep configuration on this machine, without the wandb sweep controller
+
+    `method` is "grid", "random" or "bayes" and `metric` the {"name", "goal"} a trial logs.
+    `trial_fn(params, trial)` trains one configuration and logs through `trial.log`; it
+    runs in one of `num_workers` processes, which split the cores between them. Trials
+    and metrics are kept in the SQLite file `db_path`: running the same sweep again
+    continues it, with the finished trials informing the search. `count` is the number
+    of new trials to run (grid: at most the untried configurations). An `early_terminate`
+    section ({"type": "hyperband", "min_iter", "eta", "max_iter"}) stops losing trials
+    with `SuccessiveHalving`; they count for the search with the value they stopped at.
+    '''
+
+    def __init__(self, sweep_configuration, trial_fn, db_path, num_workers=1, count=None, seed=42, initial_trials=4):
+        self.name = sweep_configuration.get("name", "sweep")
+        self.metric = sweep_configuration["metric"]["name"]
+        self.sign = -1.0 if sweep_configuration["metric"].get("goal", "maximize") == "minimize" else 1.0
+        method = sweep_configuration.get("method", "random")
+        if method not in SEARCH_METHODS:
+            raise ValueError(f"sweep method {method} is not one of {list(SEARCH_METHODS)}")
+        space = SearchSpace(sweep_configuration["parameters"])
+        kwargs = {"initial_trials": initial_trials} if method == "bayes" else {}
+        self.search = SEARCH_METHODS[method](space, seed=seed, **kwargs)
+        self.scheduler = None
+        early_terminate = dict(sweep_configuration.get("early_terminate") or {})
+        if early_terminate:
+            kind = early_terminate.pop("type")
+            if kind not in EARLY_TERMINATION:
+                raise ValueError(f"early_terminate type {kind} is not one of {list(EARLY_TERMINATION)}")
+            self.scheduler = EARLY_TERMINATION[kind](
+                **{k: v for k, v in early_terminate.items() if k in ("min_iter", "eta", "max_iter")})
+        if count is None and method != "grid":
+            raise ValueError(f"a {method} sweep needs a trial count")
+        self.count = count
+        self.trial_fn = trial_fn
+        self.num_workers = num_workers
+        self.threads = max(1, available_cores() // num_workers)
+        self.store = SweepStore(db_path)
+
+    def observations(self):
+        return [(t["params"], self.sign * t["value"])
+                for t in self.store.trials(self.name, status=("finished", "stopped"))]
+
+    def run(self):
+        self.store.interrupt_running(self.name)
+        running = {}
+        launched = 0
+        print(f"Sweep {self.name}: {self.num_workers} workers x {self.threads} threads")
+        with ProcessPoolExecutor(
+            self.num_workers,
+            # spawned, see `custom_inference.predict_sharded`
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_trial_worker,
+            initargs=(self.threads,),
+        ) as pool:
+            while True:
+                while len(running) < self.num_workers and (self.count is None or launched < self.count):
+                    params = self.search.suggest(self.observations(), [p for _, p in running.values()])
+                    if params is None:
+                        break
+                    trial_id = self.store.add_trial(self.name, params)
+                    print(f"Starting trial {trial_id}: {params}")
+                    trial = Trial(trial_id, params, self.store, self.name, self.metric, self.sign, self.scheduler)
+                    future = pool.submit(run_trial, self.trial_fn, trial)
+                    running[future] = (trial_id, params)
+                    launched += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial_id, params = running.pop(future)
+                    try:
+                        value, stopped = future.result()
+                    except Exception:
+                        self.store.fail_trial(trial_id, traceback.format_exc())
+                        print(f"Trial {trial_id} failed:\n{traceback.format_exc()}")
+                        continue
+                    status = "stopped" if stopped else "finished"
+                    self.store.finish_trial(trial_id, value, status)
+                    print(f"Trial {trial_id} {status}: {self.metric} = {value}")
+        return self.best()
+
+    def best(self):
+        finished = self.store.trials(self.name, status="finished")
+        if not finished:
+            return None
+        best = max(finished, key=lambda t: self.sign * t["value"])
+        print(f"Best trial {best['id']}: {self.metric} = {best['value']} {best['params']}")
+        return best
@@ -1,10 +1,9 @@
 import os
-import json
-from tqdm import tqdm
+import time
 
 import wandb
 import torch
-from accelerate import Accelerator
+from accelerate import Accelerator, PartialState
 from accelerate.utils import ProjectConfiguration
 
 # For checkpointing
@@ -12,7 +11,16 @@ import os
 import glob
 import re
 
+from custom_classes.custom_checkpoint import (
+    CheckpointWriter,
+    has_frozen_parameters,
+    load_model_checkpoint,
+    load_model_state,
+    trainable_state_dict,
+)
+from custom_classes.custom_inference import BackgroundInference, predict, save_predictions
 from custom_classes.custom_scheduler import InverseSqrtScheduler
+from custom_classes.custom_sampler import restore_order
 
 class FakeWandB:
 
@@ -23,17 +31,172 @@ class FakeWandB:
         self.logs.append(logs)
 
 
+class MetricsAggregator:
+    '''Running loss (weighted by examples) and token count, accumulated on the device
+
+    `update` only adds to device tensors, so the hot loop never waits for the host.
+    `flush` copies the sums of the current window to the host in one transfer and
+    is called every `log_steps` steps; the epoch totals are kept on the host. With
+    `reduce` (e.g. `Accelerator.reduce`) the window sums of all processes are added
+    up first, so every process has to flush at the same steps.
+    '''
+
+    def __init__(self, device, reduce=None):
+        self.device = device
+        self.reduce = reduce
+        self.loss_sum = 0.0
+        self.tokens = 0
+        self.examples = 0
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_loss = torch.zeros((), device=self.device)
+        self.window_tokens = torch.zeros((), device=self.device)
+        self.window_examples = 0
+
+    def update(self, loss, batch):
+        num_examples = batch["input_ids"].shape[0]
+        self.window_loss += loss.detach().float() * num_examples
+        if "attention_mask" in batch:
+            self.window_tokens += batch["attention_mask"].sum()
+        else:
+            self.window_tokens += batch["input_ids"].numel()
+        self.window_examples += num_examples
+
+    def update_losses(self, losses):
+        '''Adds per example losses, e.g. gathered from all processes'''
+        self.window_loss += losses.sum()
+        self.window_examples += losses.numel()
+
+    def flush(self):
+        sums = torch.stack([self.window_loss, self.window_tokens, torch.tensor(
+            float(self.window_examples), device=self.window_loss.device)])
+        if self.reduce is not None:
+            sums = self.reduce(sums, reduction="sum")
+        loss_sum, tokens, examples = sums.tolist()
+        examples = int(examples)
+        if not examples:
+            return None
+        window = {"loss": loss_sum / examples, "tokens": int(tokens), "examples": examples}
+        self.loss_sum += loss_sum
+        self.tokens += int(tokens)
+        self.examples += examples
+        self.reset_window()
+        return window
+
+    def average_loss(self):
+        self.flush()
+        return self.loss_sum / max(1, self.examples)
+
+
+class CompileStats:
+    '''Separates compile time from step time when the model is compiled
+
+    The first step of every new (mode, input shape) pair triggers a compile, so
+    its wall time is counted as compile time and all other steps as step time.
+    '''
+
+    def __init__(self):
+        self.shapes = set()
+        self.compile_time = 0.0
+        self.step_time = 0.0
+        self.steps = 0
+
+    def record(self, key, elapsed):
+        if key in self.shapes:
+            self.step_time += elapsed
+            self.steps += 1
+        else:
+            self.shapes.add(key)
+            self.compile_time += elapsed
+
+    def summary(self):
+        return {
+            "compile_time": self.compile_time,
+            "compiled_shapes": len(self.shapes),
+            "step_time": self.step_time / max(1, self.steps),
+        }
+
+
+class EarlyStopping:
+    '''Tracks the best value of one validation metric and the validations since it improved
+
+    `metric` "loss" is minimized, any metric returned by `task.compute_metric` is maximized,
+    None tracks the first metric the task returns. Training should stop after `patience`
+    validations without an improvement larger than `min_delta`, never if `patience` is None.
+    '''
+
+    def __init__(self, metric=None, patience=None, min_delta=0.0):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_epoch = None
+        self.best_step = None
+        self.bad_validations = 0
+
+    def value(self, val_loss, val_result):
+        if self.metric is None:
+            self.metric = next(iter(val_result))
+        if self.metric == "loss":
+            return float(val_loss)
+        if self.metric not in val_result:
+            raise KeyError(f"early_stopping_metric should be loss or one of {list(val_result)}, got {self.metric}")
+        return float(val_result[self.metric])
+
+    def step(self, val_loss, val_result, epoch, step):
+        value = self.value(val_loss, val_result)
+        sign = -1 if self.metric == "loss" else 1
+        improved = self.best is None or sign * (value - self.best) > self.min_delta
+        if improved:
+            self.best, self.best_epoch, self.best_step = value, epoch, step
+            self.bad_validations = 0
+        else:
+            self.bad_validations += 1
+        return improved
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_validations >= self.patience
+
+    def state_dict(self):
+        return {
+            "metric": self.metric,
+            "best": self.best,
+            "best_epoch": self.best_epoch,
+            "best_step": self.best_step,
+            "bad_validations": self.bad_validations,
+        }
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
+
+def resume_position(epoch, step, steps_per_epoch):
+    '''(epoch, step) training continues from, a checkpoint taken after the last batch of an epoch starts the next one'''
+    if step >= steps_per_epoch:
+        return epoch + 1, 0
+    return epoch, step
+
+
 class CustomTrainer:
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    precisions = ["fp32", "bf16"]
 
-    def __init__(self, task, wandb_config, sweep=False):
+    def __init__(self, task, wandb_config, sweep=False, logger=None):
         self.task = task
         self.sweep = sweep
-        self.resume_from_checkpoint = wandb_config.resume_from_checkpoint
-        if sweep:
+        self.resume_from_checkpoint = getattr(wandb_config, "resume_from_checkpoint", False)
+        # under `accelerate launch` / `torchrun` only the main process logs; without a GPU the
+        # processes train on the CPU (gloo), which accelerate only does when asked to
+        self.is_main_process = PartialState(cpu=not torch.cuda.is_available()).is_main_process
+        if logger is not None:
+            # anything with wandb's `log`, e.g. the `Trial` of a local sweep
+            self.wandb = logger
+        elif sweep:
             self.wandb = wandb
         else:
-            if wandb_config is not None:
+            if wandb_config is not None and self.is_main_process:
                 wandb.login(key=wandb_config.api_key)
                 if not wandb_config.resume_from_checkpoint:
                     wandb.init(
@@ -63,9 +226,25 @@ class CustomTrainer:
                 self.wandb = FakeWandB()
 
     def prepare_train(self, args):
-
-        train_dl, val_dl, test_dl = self.task.prepare()
-        total_training_steps = len(train_dl) * args.epochs
+        # one process per device, or several CPU processes (gloo) when launched with `accelerate launch --cpu`
+        self.accelerator = Accelerator(
+            cpu=not torch.cuda.is_available(), gradient_accumulation_steps=getattr(args, "grad_accum", 1))
+        self.device = self.accelerator.device
+
+        if self.accelerator.num_processes > 1 and getattr(args, "eval_max_tokens", None):
+            # `gather_for_metrics` can only drop the padding of fixed-size validation batches
+            raise ValueError("eval_max_tokens isn't supported with several processes, use val_batch")
+
+        # the main process fills the tokenization cache, the others then read it
+        with self.accelerator.main_process_first():
+            train_dl, val_dl, test_dl = self.task.prepare()
+        batch_sampler = getattr(train_dl, "batch_sampler", None)
+        if hasattr(batch_sampler, "total_batches"):
+            # variable-size batches (max_tokens) give a different batch count every epoch
+            total_training_steps = batch_sampler.total_batches(args.epochs)
+        else:
+            total_training_steps = len(train_dl) * args.epochs
+        self.accelerator.print(f"Total training steps: {total_training_steps}")
 
         self.optim = torch.optim.AdamW(
             self.task.model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay)
@@ -83,20 +262,218 @@ class CustomTrainer:
                 lr=args.learning_rate,
             )
 
+        self.precision = getattr(args, "precision", "fp32")
+        if self.precision not in self.precisions:
+            raise ValueError(f"precision should be one of {self.precisions}, got {self.precision}")
         self.task.model = self.task.model.to(self.device)
+        if self.precision == "bf16" and getattr(args, "bf16_frozen_weights", False):
+            self.cast_frozen_weights(self.task.model)
+
+        # async_checkpoint: write checkpoints on a background thread
+        # checkpoint_format: "safetensors" (weights in a separate mmap-able file) | "pt" (single file)
+        self.checkpoint_writer = CheckpointWriter(
+            asynchronous=getattr(args, "async_checkpoint", True),
+            split_model=getattr(args, "checkpoint_format", "safetensors") == "safetensors",
+        )
+        # trainable_only_checkpoint: skip the frozen (LoRA base) weights, on by default when there are any
+        self.trainable_only_checkpoint = getattr(
+            args, "trainable_only_checkpoint", has_frozen_parameters(self.task.model))
+
+        # background_test_inference: write the per-epoch test predictions from a separate CPU process (opt-in)
+        # test_inference_threads: its torch threads, taken from the cores training runs on
+        # test_best_only: only predict the test set for epochs that end on the best checkpoint
+        self.background_inference = None
+        if getattr(args, "background_test_inference", False):
+            self.background_inference = BackgroundInference(getattr(args, "test_inference_threads", 1))
+        self.test_best_only = getattr(args, "test_best_only", False)
+
+        # log_steps: steps between two host syncs for logging
+        self.log_steps = getattr(args, "log_steps", 50)
+
+        # early_stopping_metric: validation metric the best checkpoint is picked by ("loss" or e.g. "f1")
+        # early_stopping_patience: validations without improvement before training stops, None never stops
+        self.early_stopping = EarlyStopping(
+            getattr(args, "early_stopping_metric", None),
+            getattr(args, "early_stopping_patience", None),
+            getattr(args, "early_stopping_min_delta", 0.0),
+        )
+        # val_steps: also validate every val_steps training steps, on a fixed stratified subsample of
+        # val_subsample examples (or a fraction) of the validation split; early stopping then uses these
+        self.val_steps = getattr(args, "val_steps", None)
+        self.subsample_dl, self.subsample_metric = None, None
+        if self.val_steps:
+            try:
+                self.subsample_dl, self.subsample_metric = self.task.validation_subsample(
+                    getattr(args, "val_subsample", 1000))
+                self.accelerator.print(f"Validating every {self.val_steps} steps on {len(self.subsample_dl.dataset)} examples")
+            except NotImplementedError as e:
+                self.accelerator.print(f"Warning: no mid-epoch validation, {e}")
+                self.val_steps = None
+
+        self.compile_buckets = None
+        self.compile_stats = CompileStats()
+        if getattr(args, "compile", False):
+            self.compile_model(args)
 
         return train_dl, val_dl, test_dl
 
-    def save_checkpoint(self, checkpoint_path, epoch, step, model, optimizer, scheduler):
+    def compile_model(self, args):
+        # compile_buckets: sequence lengths batches are padded up to, so there is one graph per
+        # bucket (and batch size) instead of one per padded length
+        max_seq_len = getattr(args, "max_seq_len", None) or 512
+        self.compile_buckets = sorted(getattr(
+            args, "compile_buckets", [max_seq_len // 8, max_seq_len // 4, max_seq_len // 2, max_seq_len]))
+        # train and eval mode each compile their own graphs
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 4 * len(self.compile_buckets))
+        # a graph that fails to compile runs in eager mode instead
+        torch._dynamo.config.suppress_errors = True
+        # in place, so parameter names (and checkpoints) stay the same as in eager mode
+        self.task.model.compile(dynamic=False)
+        self.accelerator.print(f"Compiling the model for sequence length buckets {self.compile_buckets}")
+
+    def pad_to_bucket(self, batch):
+        if not self.compile_buckets:
+            return batch
+        length = batch["input_ids"].shape[1]
+        bucket = next((b for b in self.compile_buckets if b >= length), length)
+        if bucket == length:
+            return batch
+        padding = (bucket - length, 0) if self.task.tokenizer.padding_side == "left" else (0, bucket - length)
+        pad_values = {"input_ids": self.task.tokenizer.pad_token_id}
+        for key in ("input_ids", "attention_mask", "token_type_ids"):
+            if key in batch:
+                batch[key] = torch.nn.functional.pad(batch[key], padding, value=pad_values.get(key, 0))
+        return batch
+
+    def autocast(self):
+        # not accelerate's mixed_precision: its state is process-wide and fixed by the first
+        # Accelerator, while sweeps train several configs in one process
+        return torch.autocast(
+            device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=getattr(self, "precision", "fp32") == "bf16")
+
+    @staticmethod
+    def cast_frozen_weights(model, dtype=torch.bfloat16):
+        # e.g. the LoRA base model: trainable weights and their optimizer state stay in fp32
+        for param in model.parameters():
+            if not param.requires_grad and param.is_floating_point():
+                param.data = param.data.to(dtype)
+
+    def validate(self, model, val_dl, epoch, compute_metric=None, prefix="val"):
+        # eval mode turns off dropout (LoRA dropout included), the previous mode is restored after
+        name = "validation" if prefix == "val" else prefix
+        was_training = model.training
+        model.eval()
+        val_metrics = MetricsAggregator(self.device)
+        preds = []
+        labels = []
+        try:
+            with torch.inference_mode():
+                for step, batch in enumerate(val_dl):
+                    # ========== forward pass ==========
+                    batch = self.pad_to_bucket(batch)
+                    with self.autocast():
+                        outputs = model(**batch)
+                        loss = self.task.loss_function(outputs, batch)
+
+                    # ========== compute metric ==========
+                    # gathered from all processes in batch order, without the padding of the last batches
+                    preds.extend(self.accelerator.gather_for_metrics(
+                        self.task.extract_answer_from_output(outputs)
+                    ))
+                    labels.extend(self.accelerator.gather_for_metrics(
+                        self.task.extract_label_from_input(batch)
+                    ))
+
+                    # ========== logging ==========
+                    val_metrics.update_losses(self.accelerator.gather_for_metrics(
+                        loss.detach().float().expand(batch["input_ids"].shape[0]).contiguous()))
+                    if (step + 1) % self.log_steps == 0:
+                        self.accelerator.print("Epoch {} {} loss: {}".format(
+                            step/len(val_dl), name, val_metrics.flush()["loss"]), end="\r")
+        finally:
+            model.train(was_training)
+
+        val_loss = val_metrics.average_loss()
+        self.wandb.log({f"{prefix}/loss": val_loss})
+        self.accelerator.print("Epoch {} avg {} loss: {}".format(epoch, name, val_loss))
+        preds = restore_order(val_dl, preds)
+        labels = restore_order(val_dl, labels)
+        val_result = (compute_metric or self.task.compute_metric)(preds, labels)
+        self.accelerator.print("Epoch {} {} acc: {}".format(
+            epoch, name, val_result))
+        self.wandb.log(
+            {"{}/{}".format(prefix, i): j for i, j in val_result.items()})
+        return val_loss, val_result
+
+    def track_best(self, args, val_loss, val_result, epoch, step, model, save_checkpoint):
+        '''Updates early stopping, on an improvement `best_checkpoint.json` points to this state
+
+        The checkpoint of this state is written after the update (always with `save_checkpoint`, else
+        only on an improvement), so it holds the early stopping state of this validation.
+        '''
+        improved = self.early_stopping.step(val_loss, val_result, epoch, step)
+        if not improved:
+            self.accelerator.print(f"No improvement of {self.early_stopping.metric} for {self.early_stopping.bad_validations} "
+                  f"validations, best {self.early_stopping.best} at epoch {self.early_stopping.best_epoch} "
+                  f"step {self.early_stopping.best_step}")
+        if args.checkpoint_path and (improved or save_checkpoint):
+            self.save_checkpoint(args.checkpoint_path, epoch, step, model, self.optim, self.scheduler)
+        if not improved:
+            return
+        self.wandb.log({f"val/best_{self.early_stopping.metric}": self.early_stopping.best})
+        if not args.checkpoint_path or not self.accelerator.is_main_process:
+            return
+        self.checkpoint_writer.write_json({
+            "checkpoint": f"epoch_{epoch}_step_{step}.pt",
+            "epoch": epoch,
+            "step": step,
+            "metric": self.early_stopping.metric,
+            "value": self.early_stopping.best,
+        }, os.path.join(args.checkpoint_path, "best_checkpoint.json"))
+
+    def pruned(self):
+        # a local sweep's early termination (ASHA) ends losing trials at its rungs, see `custom_sweep.Trial`
+        return getattr(self.wandb, "should_stop", False)
+
+    def log_train_window(self, train_metrics, progress):
+        window = train_metrics.flush()
+        if window is None:
+            return
+        self.wandb.log({
+            "train/loss": window["loss"],
+            "train/learning_rate": self.scheduler.get_last_lr()[0],
+            "train/tokens": window["tokens"],
+        })
+        self.accelerator.print("Epoch {} training loss: {}".format(progress, window["loss"]), end="\r")
+
+    def save_checkpoint(self, checkpoint_path, epoch, step, model, optimizer, scheduler, gather_rng_state=True):
+        # `step` is the number of training batches of `epoch` that are done (by each process)
+        rng_state = torch.get_rng_state()
+        if gather_rng_state and self.accelerator.num_processes > 1:
+            # every process draws its own dropout masks; called by all processes
+            rng_state = self.accelerator.gather(rng_state[None].to(self.device)).cpu()
+        if not self.accelerator.is_main_process:
+            # the weights and optimizer state are the same on every process
+            return
         os.makedirs(checkpoint_path, exist_ok=True)
         checkpoint_file = os.path.join(checkpoint_path, f"epoch_{epoch}_step_{step}.pt")
+        batch_sampler = self.train_batch_sampler()
+        model = self.accelerator.unwrap_model(model)
 
-        torch.save({
+        # AdamW only keeps state for parameters that get gradients, so the optimizer
+        # state is already limited to the trainable parameters
+        self.checkpoint_writer.save({
             'epoch': epoch,
             'step': step,
-            'model_state_dict': model.state_dict(),
+            'trainable_only': self.trainable_only_checkpoint,
+            'model_state_dict': trainable_state_dict(model) if self.trainable_only_checkpoint else model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
-            'scheduler_state_dict': scheduler.state_dict()
+            'scheduler_state_dict': scheduler.state_dict(),
+            'sampler_state_dict': batch_sampler.state_dict() if hasattr(batch_sampler, "state_dict") else None,
+            # dropout masks continue where they left off
+            'rng_state': rng_state,
+            'early_stopping_state_dict': self.early_stopping.state_dict(),
         }, checkpoint_file)
 
     def load_checkpoint(self, checkpoint_path, model, optimizer, scheduler):
@@ -124,57 +501,107 @@ class CustomTrainer:
             return 0, 0
 
         # Load everything
-        checkpoint = torch.load(latest_file, map_location=self.device)
-        model.load_state_dict(checkpoint['model_state_dict'])
+        # read to CPU memory (accelerate's multi-process CPU device "cpu:0" isn't a valid location),
+        # `load_state_dict` copies to the device of the parameters
+        checkpoint = torch.load(latest_file, map_location="cpu")
+        if 'model_state_dict' not in checkpoint:
+            checkpoint.update(load_model_checkpoint(latest_file, "cpu"))
+        load_model_state(self.accelerator.unwrap_model(model), checkpoint)
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        if 'rng_state' in checkpoint:
+            rng_state = checkpoint['rng_state'].cpu()
+            if rng_state.dim() == 2:
+                # one per process, the main process' one if the number of processes changed
+                # (cloned: `set_rng_state` ignores the storage offset of a row)
+                rng_state = rng_state[
+                    self.accelerator.process_index if len(rng_state) == self.accelerator.num_processes else 0].clone()
+            torch.set_rng_state(rng_state)
+        if 'early_stopping_state_dict' in checkpoint:
+            self.early_stopping.load_state_dict(checkpoint['early_stopping_state_dict'])
+        batch_sampler = self.train_batch_sampler()
+        sampler_state = checkpoint.get('sampler_state_dict')
+        if hasattr(batch_sampler, "state_dict") and sampler_state not in (None, batch_sampler.state_dict()):
+            self.accelerator.print(f"Warning: the checkpoint was trained with batch order {sampler_state}, "
+                                   f"resuming with {batch_sampler.state_dict()}")
+        self.accelerator.print(f"Resuming from {latest_file}")
         return checkpoint['epoch'], checkpoint['step']
 
+    def train_batch_sampler(self):
+        # with several processes accelerate wraps it in a `BatchSamplerShard`
+        batch_sampler = getattr(self.train_dl, "batch_sampler", None)
+        return getattr(batch_sampler, "batch_sampler", batch_sampler)
+
+    def resume_train_iterator(self, train_dl, batches_done):
+        batch_sampler = self.train_batch_sampler()
+        if hasattr(batch_sampler, "resume") and self.accelerator.num_processes > 1:
+            # skipped after the batches are sharded, so the last batches are padded as without a resume
+            return iter(self.accelerator.skip_first_batches(train_dl, batches_done))
+        if hasattr(batch_sampler, "resume"):
+            # seeded samplers skip the batches by index, no data is loaded for them
+            batch_sampler.resume(batches_done)
+            return iter(train_dl)
+        self.accelerator.print(f"Skipping {batches_done} batches by iterating over them (e.g. streaming)")
+        train_dl_iter = iter(train_dl)
+        for _ in range(batches_done):
+            next(train_dl_iter)
+        return train_dl_iter
+
     def train(self, args):
         self.task.model.train()
-        device = self.device
         train_dl, val_dl, test_dl = self.prepare_train(args)
+        # the main process writes the test predictions, see `evaluate`
         self.test_dl = test_dl
         # project_config = ProjectConfiguration(project_dir=args.output_path, automatic_checkpoint_naming=True)
         # accelerator = Accelerator(project_config=project_config, gradient_accumulation_steps=args.grad_accum)
-        accelerator = Accelerator(gradient_accumulation_steps=args.grad_accum)
-        model, self.optim, train_dl, self.scheduler = accelerator.prepare(
-            self.task.model, self.optim, train_dl, self.scheduler
+        accelerator = self.accelerator
+        # batches arrive on `accelerator.device`, validation batches are split across the processes
+        model, self.optim, train_dl, self.scheduler, val_dl = accelerator.prepare(
+            self.task.model, self.optim, train_dl, self.scheduler, val_dl
         )
+        if self.subsample_dl is not None:
+            self.subsample_dl = accelerator.prepare(self.subsample_dl)
+        self.train_dl = train_dl
 
         self.task.print_model_params()
         steps_per_epoch = len(train_dl)
-        val_steps_per_epoch = len(val_dl)
 
         # ========== load checkpoints ==========
         start_epoch, current_step = 0, 0
         if args.checkpoint_path and self.resume_from_checkpoint and os.path.exists(args.checkpoint_path):
             start_epoch, current_step = self.load_checkpoint(
                 args.checkpoint_path, model, self.optim, self.scheduler)
+            # the number of batches of max_tokens epochs depends on the epoch
+            if hasattr(self.train_batch_sampler(), "set_epoch"):
+                self.train_batch_sampler().set_epoch(start_epoch)
+            start_epoch, current_step = resume_position(start_epoch, current_step, len(train_dl))
 
+        stop = False
         try:
             for epoch in range(start_epoch, args.epochs):
                 model.train()
-                current_step += 1
                 # ========== training ==========
-                losses = []
-                num_datapoints = 0
-
-                # if current_step > 1:
-                #     train_dl_iter = iter(train_dl)
-                #     for _ in range(current_step):
-                #         next(train_dl_iter)
-                # else:
-                train_dl_iter = iter(train_dl)
+                train_metrics = MetricsAggregator(self.device, reduce=accelerator.reduce)
+
+                # the batch order of an epoch only depends on the seed and the epoch, also after a resume
+                train_dl.set_epoch(epoch)
+                if hasattr(self.train_batch_sampler(), "set_epoch"):
+                    self.train_batch_sampler().set_epoch(epoch)
+                if current_step > 0:
+                    train_dl_iter = self.resume_train_iterator(train_dl, current_step)
+                else:
+                    train_dl_iter = iter(train_dl)
 
                 for batch in train_dl_iter:
 
                     with accelerator.accumulate(model):
 
                         # ========== forward pass ==========
-                        batch = {i: j.to(device) for i, j in batch.items()}
-                        outputs = model(**batch)
-                        loss = self.task.loss_function(outputs, batch)
+                        step_start = time.perf_counter()
+                        batch = self.pad_to_bucket(batch)
+                        with self.autocast():
+                            outputs = model(**batch)
+                            loss = self.task.loss_function(outputs, batch)
 
                         # ========== backpropagation ==========
                         accelerator.backward(loss)
@@ -183,78 +610,76 @@ class CustomTrainer:
                         self.optim.zero_grad()
 
                         # ========== logging ==========
-                        loss_for_logging = loss.detach().tolist()
-                        losses.append(loss_for_logging*len(batch))
-                        num_datapoints += len(batch)
-                        self.wandb.log({
-                            "train/loss": loss_for_logging,
-                            "train/learning_rate": self.scheduler.get_last_lr()[0]
-                        })
-                        print("Epoch {} training loss: {}".format(
-                            current_step/steps_per_epoch, loss_for_logging), end="\r")
-
-                    # ========== save checkpoints ==========
-                    if args.checkpoint_path and current_step % args.checkpoint_steps == 0:
+                        current_step += 1
+                        train_metrics.update(loss, batch)
+                        self.compile_stats.record(
+                            ("train", ) + tuple(batch["input_ids"].shape), time.perf_counter() - step_start)
+                        if current_step % self.log_steps == 0:
+                            self.log_train_window(train_metrics, current_step/steps_per_epoch)
+
+                    # ========== mid-epoch validation and checkpoints ==========
+                    checkpoint_due = bool(args.checkpoint_path) and current_step % args.checkpoint_steps == 0
+                    if self.val_steps and current_step % self.val_steps == 0:
+                        val_loss, val_result = self.validate(
+                            model, self.subsample_dl, epoch + current_step/steps_per_epoch,
+                            compute_metric=self.subsample_metric, prefix="val_subsample")
+                        self.track_best(args, val_loss, val_result, epoch, current_step, model, checkpoint_due)
+                        if self.early_stopping.should_stop or self.pruned():
+                            stop = True
+                            break
+                    elif checkpoint_due:
                         self.save_checkpoint(
                             args.checkpoint_path, epoch, current_step, model, self.optim, self.scheduler)
 
-                    current_step += 1
-
-                print("\nEpoch {} avg training loss: {}".format(
-                    epoch, sum(losses)/num_datapoints))
+                self.log_train_window(train_metrics, current_step/steps_per_epoch)
+                accelerator.print("\nEpoch {} avg training loss: {}".format(
+                    epoch, train_metrics.average_loss()))
+                if self.compile_buckets:
+                    compile_summary = self.compile_stats.summary()
+                    accelerator.print("Epoch {} compile time: {:.1f}s for {} shapes | avg step time: {:.3f}s".format(
+                        epoch, compile_summary["compile_time"], compile_summary["compiled_shapes"],
+                        compile_summary["step_time"]))
+                    self.wandb.log({"train/{}".format(i): j for i, j in compile_summary.items()})
+                if stop:
+                    break
 
                 # ========== validation ==========
-                val_losses = []
-                num_datapoints = 0
-                preds = []
-                labels = []
-                with torch.no_grad():
-                    for step, batch in enumerate(val_dl):
-                        # ========== forward pass ==========
-                        batch = {i: j.to(self.device)
-                                 for i, j in batch.items()}
-                        outputs = model(**batch)
-                        loss = self.task.loss_function(outputs, batch)
-
-                        # ========== compute metric ==========
-                        preds.extend(
-                            self.task.extract_answer_from_output(outputs)
-                        )
-                        labels.extend(
-                            self.task.extract_label_from_input(batch)
-                        )
-
-                        # ========== logging ==========
-                        val_loss_for_logging = loss.detach().tolist()
-                        val_losses.append(val_loss_for_logging*len(batch))
-                        num_datapoints += len(batch)
-                        print("Epoch {} validation loss: {}".format(
-                            step/val_steps_per_epoch, val_loss_for_logging), end="\r")
-
-                    self.wandb.log(
-                        {"val/loss": sum(val_losses)/num_datapoints})
-                    print("Epoch {} avg validation loss: {}".format(
-                        epoch, sum(val_losses)/num_datapoints))
-                    val_result = self.task.compute_metric(preds, labels)
-                    print("Epoch {} validation acc: {}".format(
-                        epoch, val_result))
-                    self.wandb.log(
-                        {"val/{}".format(i): j for i, j in val_result.items()})
+                val_loss, val_result = self.validate(model, val_dl, epoch)
 
                 # ========== save checkpoints ==========
-                if args.checkpoint_path:
-                    self.save_checkpoint(args.checkpoint_path, epoch, len(
-                        train_dl), model, self.optim, self.scheduler)
+                if not self.val_steps:
+                    self.track_best(args, val_loss, val_result, epoch, current_step, model, save_checkpoint=True)
+                    stop = self.early_stopping.should_stop
+                elif args.checkpoint_path:
+                    self.save_checkpoint(args.checkpoint_path, epoch, current_step, model, self.optim, self.scheduler)
+                stop = stop or self.pruned()
                 self.task.model = model
-                self.evaluate(args.checkpoint_path, epoch)
+                if not self.test_best_only or (
+                        self.early_stopping.best_epoch, self.early_stopping.best_step) == (epoch, current_step):
+                    self.evaluate(args.checkpoint_path, epoch)
                 current_step = 0
+                if stop:
+                    break
+
+            if stop and self.pruned():
+                accelerator.print(f"Stopped by the sweep scheduler after epoch {epoch}")
+            elif stop:
+                accelerator.print(f"Early stopping: {self.early_stopping.metric} didn't improve for "
+                      f"{self.early_stopping.patience} validations, best {self.early_stopping.best} "
+                      f"at epoch {self.early_stopping.best_epoch} step {self.early_stopping.best_step}")
 
         # ========== save checkpoints ==========
         except KeyboardInterrupt:
-            print("Interrupted. Saving checkpoint...")
+            accelerator.print("Interrupted. Saving checkpoint...")
+            # the processes may be interrupted at different steps, so no collective call
             self.save_checkpoint(args.checkpoint_path, epoch,
-                                 current_step, model, self.optim, self.scheduler)
+                                 current_step, model, self.optim, self.scheduler, gather_rng_state=False)
             raise
+        finally:
+            # the last checkpoint and test predictions have to be on disk before returning
+            self.checkpoint_writer.wait()
+            if self.background_inference is not None:
+                self.background_inference.wait()
 
     # def evaluate(self, dl):
     #     pred_list = []
@@ -274,33 +699,31 @@ class CustomTrainer:
 
     def evaluate(self, output_path, epoch):
         test_dl = self.test_dl
+        if test_dl is None:
+            # e.g. SQuADv2 has no test split
+            return
+        if not self.accelerator.is_main_process:
+            return
         output_file = os.path.join(output_path, f"epoch_{epoch}_testset_evaluation.json")
-        self.task.print_model_params()
-        model = self.task.model
+        model = self.accelerator.unwrap_model(self.task.model)
+        # ========== background evaluation ==========
+        if self.background_inference is not None:
+            print(f"Writing inference results @ {output_file} in the background")
+            self.background_inference.submit(
+                model, test_dl, self.task.extract_answer_from_output, self.task.test_idx, output_file, self.precision)
+            return
+
         # ========== evaluation ==========
-        preds = []
-        labels = []
-        model.eval()
-        with torch.no_grad():
-            for step, batch in enumerate(tqdm(test_dl)):
-                # ========== forward pass ==========
-
-                batch = {i: j.to(self.device) for i, j in batch.items()}
-                batch.pop("labels")
-                outputs = model(**batch)
-
-                # ========== compute metric ==========
-                preds.extend(
-                    self.task.extract_answer_from_output(outputs)
-                )
-
-        assert len(self.task.test_idx) == len(
-            preds), "test idx number and prediction number doesn't match!"
-        results = dict()
-        for idx, pred in zip(self.task.test_idx, preds):
-            results[idx] = pred
-        print(f"Saving inference results @ {output_file}")
-        json.dump(results, open(output_file, 'w'))
-        # val_result = self.task.compute_metric(preds, labels)
-        # print("Test set acc: {}".format(val_result), file=open(output_file, 'w'))
-        # return val_result
+        self.task.print_model_params()
+        was_training = model.training
+        try:
+            preds, batch_idx = predict(
+                model,
+                test_dl,
+                self.task.extract_answer_from_output,
+                self.autocast,
+                lambda batch: self.pad_to_bucket({i: j.to(self.device) for i, j in batch.items()}),
+            )
+        finally:
+            model.train(was_training)
+        save_predictions(preds, batch_idx or self.task.test_idx, output_file)
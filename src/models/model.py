@@ -7,6 +7,7 @@ from transformers import (
 )
 
 from utils import register_to, MODEL_REGISTRY
+from utils.cache_utils import pretrained_model
 
 
 @register_to(MODEL_REGISTRY)
@@ -15,12 +16,13 @@ def DummyModel(model_name, **kwargs):
 
 @register_to(MODEL_REGISTRY)
 def SequenceClassificationModel(model_name, **kwargs):
-    return AutoModelForSequenceClassification.from_pretrained(model_name, **kwargs)
+    return pretrained_model(AutoModelForSequenceClassification, model_name, **kwargs)
 
 
 @register_to(MODEL_REGISTRY)
 def SequenceClassificationLoRA(model_name, lora_r, lora_alpha, **kwargs):
-    model = AutoModelForSequenceClassification.from_pretrained(model_name, **kwargs)
+    # the base weights stay frozen, only the adapters and the (copied) head are new
+    model = pretrained_model(AutoModelForSequenceClassification, model_name, frozen=True, **kwargs)
     lora_config = LoraConfig(
         r=lora_r,
         target_modules=["query", "value"],
@@ -32,11 +34,11 @@ def SequenceClassificationLoRA(model_name, lora_r, lora_alpha, **kwargs):
 
 @register_to(MODEL_REGISTRY)
 def QuestionAnsweringModel(model_name, **kwargs):
-    return AutoModelForQuestionAnswering.from_pretrained(model_name)
+    return pretrained_model(AutoModelForQuestionAnswering, model_name)
 
 @register_to(MODEL_REGISTRY)
 def QuestionAnsweringModelLoRA(model_name, lora_r, lora_alpha, **kwargs):
-    model = AutoModelForQuestionAnswering.from_pretrained(model_name)
+    model = pretrained_model(AutoModelForQuestionAnswering, model_name, frozen=True)
     lora_config = LoraConfig(
         r=lora_r,
         target_modules=["query", "value"],
@@ -0,0 +1,86 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import (
+    MODEL_REGISTRY,
+    TASK_REGISTRY,
+    make_registry_entry,
+)
+from utils.data_utils import available_cores
+
+# Warms the tokenization cache for every registered task, e.g. on a fresh machine
+# before a batch of jobs:
+#   python3 pretokenize.py --model-name FacebookAI/roberta-base --max-seq-len 512
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--tasks",
+                        nargs="+",
+                        default=None,
+                        help="task names from TASK_REGISTRY, defaults to all of them",
+    )
+
+    parser.add_argument("--model-name",
+                        default="FacebookAI/roberta-base",
+                        type=str,
+    )
+
+    parser.add_argument("--max-seq-len",
+                        default=512,
+                        type=int,
+    )
+
+    parser.add_argument("--cache-dir",
+                        default=None,
+                        type=str,
+    )
+
+    parser.add_argument("--jobs",
+                        default=None,
+                        type=int,
+                        help="tasks tokenized concurrently, defaults to one per task up to the core count",
+    )
+
+    return parser.parse_args()
+
+
+class Args():
+    def __init__(self, **kwargs):
+        for k, i in kwargs.items():
+            setattr(self, k, i)
+
+
+def pretokenize_task(task_name, model_name, max_seq_len, cache_dir, num_proc):
+    make_registry_entry()
+    task_args = Args(task_name=task_name, model_name=model_name, lora_r=None)
+    train_args = Args(max_seq_len=max_seq_len, cache_dir=cache_dir, num_proc=num_proc)
+    # DummyModel keeps the model weights from being loaded
+    task = TASK_REGISTRY[task_name](task_args, train_args, MODEL_REGISTRY["DummyModel"])
+    for split in task.dataset_splits():
+        task.tokenized_split(split)
+    return task_name, task.cache.hits, task.cache.misses
+
+
+def main(args):
+    make_registry_entry()
+    task_names = args.tasks or list(TASK_REGISTRY)
+    cores = available_cores()
+    jobs = args.jobs or min(len(task_names), cores)
+    # the cores left over by the concurrent tasks shard each task's `datasets.map`
+    num_proc = max(1, cores // jobs)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(pretokenize_task, task_name, args.model_name, args.max_seq_len, args.cache_dir, num_proc)
+            for task_name in task_names
+        ]
+        for future in as_completed(futures):
+            task_name, hits, misses = future.result()
+            print(f"{task_name}: {hits} splits already cached | {misses} splits tokenized")
+
+
+if __name__=="__main__":
+    args = parse_args()
+    main(args)
@@ -1,19 +1,62 @@
 import os
 import sys
 import wandb
-import importlib
+from functools import partial
 
 from custom_classes.custom_trainer import CustomTrainer
+from custom_classes.custom_sweep import LocalSweep
 from utils import (
     MODEL_REGISTRY,
     TASK_REGISTRY,
     TRAINER_REGISTRY,
     read_config,
-    set_seed,
+    make_registry_entry,
 )
 
-importlib.import_module("model")
-importlib.import_module("task")
+from utils.model_utils import set_seed
+from utils.cache_utils import RESOURCE_CACHE
+
+def apply_params(args, params, run_name):
+    # note that we define values from the sweep parameters
+    # instead of defining hard values
+    args['train'].learning_rate = params["lr"]
+    args['train'].train_batch = params["batch_size"]
+    args['train'].epochs = params["epochs"]
+    args['task'].lora_r = params["lora_r"]
+    args['task'].lora_alpha = params["lora_alpha"]
+    args['train'].checkpoint_path = os.path.join(
+        args['train'].checkpoint_path_parent, f"config_{run_name}")
+    print("save checkpoint to ", args['train'].checkpoint_path)
+
+def local_trial(config_path, params, trial):
+    # runs in a worker process of `LocalSweep`, which keeps its resource cache between trials
+    make_registry_entry()
+    RESOURCE_CACHE.enable()
+    set_seed(42)
+    args = read_config(config_path)
+    task_class = TASK_REGISTRY.get(args['task'].task_name)
+    model_fn = MODEL_REGISTRY.get(args['task'].model)
+    args['train'].checkpoint_path_parent = args['train'].checkpoint_path
+    apply_params(args, params, f"trial_{trial.id}")
+    task = task_class(args['task'], args['train'], model_fn)
+    trainer = CustomTrainer(task, None, sweep=True, logger=trial)
+    trainer.train(args['train'])
+
+def main_local(config_path):
+    args = read_config(config_path)
+    wandb_config = args['wandb_config']
+    sweep = LocalSweep(
+        wandb_config.sweep_configuration,
+        partial(local_trial, config_path),
+        # sweep_db: SQLite file of the trials and their metrics, running the sweep again continues it
+        db_path=getattr(wandb_config, "sweep_db", None) or os.path.join(args['train'].checkpoint_path, "sweep.db"),
+        # sweep_workers: trials trained at the same time, the cores are split between them
+        num_workers=getattr(wandb_config, "sweep_workers", 1),
+        count=getattr(wandb_config, "sweep_count", 7),
+        seed=getattr(args['train'], "seed", 42),
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(sweep.store.path)), exist_ok=True)
+    sweep.run()
 
 def main(config_path):
     set_seed(42)
@@ -29,31 +72,28 @@ def main(config_path):
         # Track hyperparameters and run metadata
     )
     args['train'].checkpoint_path_parent = args['train'].checkpoint_path
+    # trials share the tokenizer, the tokenized splits and the pretrained weights
+    RESOURCE_CACHE.enable()
 
     def sweep_function():
 
         wandb.init()
 
         print("Sweep run name", wandb.config._settings.run_name)
-        # note that we define values from `wandb.config`
-        # instead of defining hard values
-        args['train'].learning_rate = wandb.config.lr
-        args['train'].train_batch = wandb.config.batch_size
-        args['train'].epochs = wandb.config.epochs
-        args['task'].lora_r = wandb.config.lora_r
-        args['task'].lora_alpha = wandb.config.lora_alpha
-        args['train'].checkpoint_path = os.path.join(
-            args['train'].checkpoint_path_parent, f"config_{wandb.config._settings.run_name}")
-        print("save checkpoint to ", args['train'].checkpoint_path)
+        apply_params(args, wandb.config, wandb.config._settings.run_name)
         task = task_class(args['task'], args['train'], model_fn)
         trainer = CustomTrainer(task, args.get("wandb_config", None), sweep=True)
         trainer.train(args['train'])
 
-    wandb.agent(sweep_id, function=sweep_function, count=7)
+    wandb.agent(sweep_id, function=sweep_function, count=getattr(wandb_config, "sweep_count", 7))
 
 if __name__=="__main__":
-    assert len(sys.argv) == 3, f"{sys.argv} define mode (train | eval) and config"
+    assert len(sys.argv) == 3, f"{sys.argv} define mode (train | local) and config"
     print("Executing python3", sys.argv)
     mode = sys.argv[1]
     config = sys.argv[2]
-    main(config)
+    make_registry_entry()
+    if mode == "local":
+        main_local(config)
+    else:
+        main(config)
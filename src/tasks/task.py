@@ -1,10 +1,19 @@
+import os
+import json
+import shutil
+import inspect
+import hashlib
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 import torch
+from torch.utils.data import IterableDataset
 from torch.utils.data.dataloader import DataLoader
 
 from evaluate import load
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 from transformers import DataCollatorWithPadding
 from transformers import (
     AutoModelForQuestionAnswering,
@@ -13,24 +22,107 @@ from transformers import (
 )
 
 from utils import register_to, TASK_REGISTRY
-from utils.qa_utils import postprocess_qa_predictions
+from utils.cache_utils import RESOURCE_CACHE
+from utils.qa_utils import (
+    first_answer_char_spans,
+    label_answer_spans,
+    postprocess_qa_predictions,
+)
+from utils.data_utils import (
+    dataloader_kwargs,
+    num_proc,
+    split_intra_op_threads,
+    stratified_subsample,
+    to_list_array,
+)
+from custom_classes.custom_dataset import StreamingDataset, TokenStore
+from custom_classes.custom_sampler import (
+    BucketBatchSampler,
+    RandomBatchSampler,
+    SortedBatchSampler,
+    TokenBudgetBatchSampler,
+    sequence_lengths,
+)
 
 # GENE ADDED
 from functools import partial
-from transformers.data.metrics.squad_metrics import compute_exact, compute_f1, make_eval_dict
+from itertools import chain
+from transformers.data.metrics.squad_metrics import compute_exact, compute_f1, make_eval_dict, normalize_answer
+
+class TokenizationCache:
+    '''Content-addressed on-disk store of tokenized dataset splits.
+
+    Every entry lives in `cache_dir/<key>` where the key is a hash of everything that
+    changes the tokenized output (task, tokenizer name/revision, max_seq_len, input
+    fields, split and the source of the processing function). Entries are written to a
+    temporary directory first and renamed into place, so concurrent jobs never observe
+    a half-written split.
+    '''
+    default_dir = os.path.join(os.path.expanduser("~"), ".cache", "nlp-trainer", "tokenized")
+
+    def __init__(self, cache_dir=None, enabled=True):
+        self.cache_dir = cache_dir or os.environ.get("NLP_TRAINER_CACHE_DIR", self.default_dir)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**fields):
+        payload = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def load_or_build(self, key, build_fn, description=""):
+        if not self.enabled:
+            return build_fn()
+        # loaded once per process when `RESOURCE_CACHE` is on, e.g. for every trial of a sweep
+        resource_key = ("tokenized", key)
+        if resource_key in RESOURCE_CACHE:
+            self.hits += 1
+            print(f"Tokenization cache hit {description} (in memory)")
+        return RESOURCE_CACHE.get(resource_key, lambda: self.load_or_build_on_disk(key, build_fn, description))
+
+    def load_or_build_on_disk(self, key, build_fn, description=""):
+        path = os.path.join(self.cache_dir, key)
+        if os.path.exists(path):
+            self.hits += 1
+            print(f"Tokenization cache hit {description} @ {path}")
+            return load_from_disk(path)
+
+        self.misses += 1
+        print(f"Tokenization cache miss {description}, building @ {path}")
+        ds = build_fn()
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        ds.save_to_disk(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return load_from_disk(path)
+
+    def report(self):
+        print(f"Tokenization cache: {self.hits} hits | {self.misses} misses")
+
 
 class TaskClass:
+    # module-level functions `process_function` calls; their source is part of the tokenization cache key
+    process_helpers = ()
 
     def __init__(self, task_args, train_args, model_fn):
         self.train_args = train_args
         self.task_args = task_args
-        self.tokenizer = AutoTokenizer.from_pretrained(task_args.model_name)
+        self.tokenizer = RESOURCE_CACHE.get(
+            ("tokenizer", task_args.model_name), lambda: AutoTokenizer.from_pretrained(task_args.model_name))
         if getattr(train_args, "from_hf", None):
             task_args.model_name = train_args.checkpoint
         self.data_collator = DataCollatorWithPadding(tokenizer=self.tokenizer)
+        self.cache = TokenizationCache(
+            getattr(train_args, "cache_dir", None),
+            enabled=getattr(train_args, "tokenization_cache", True),
+        )
         self.init_model(model_fn, task_args)
 
-    def init_model(self):
+    def init_model(self, model_fn, task_args):
         raise NotImplementedError
 
     @staticmethod
@@ -43,6 +135,12 @@ class TaskClass:
     def prepare(self):
         raise NotImplementedError
 
+    def dataset_splits(self):
+        raise NotImplementedError
+
+    def tokenized_split(self, split):
+        raise NotImplementedError
+
     def prepare_eval(self):
         raise NotImplementedError
 
@@ -58,6 +156,104 @@ class TaskClass:
     def compute_metric(self, preds, labels):
         raise NotImplementedError
 
+    def validation_subsample(self, size):
+        '''(dataloader, compute_metric) over a fixed stratified subsample of the validation split'''
+        raise NotImplementedError
+
+    def cache_key(self, split, **extra):
+        tokenizer_revision = getattr(self.task_args, "tokenizer_revision", None) \
+            or self.tokenizer.init_kwargs.get("_commit_hash")
+        return self.cache.make_key(
+            task=type(self).__name__,
+            split=split,
+            tokenizer=self.tokenizer.name_or_path,
+            tokenizer_revision=tokenizer_revision,
+            vocab_size=len(self.tokenizer),
+            max_seq_len=getattr(self.train_args, "max_seq_len", None),
+            process_function=inspect.getsource(self.process_function),
+            helpers=[inspect.getsource(f) for f in self.process_helpers],
+            **extra,
+        )
+
+    def token_store(self, dataset):
+        # stores live next to the tokenization cache entries, keyed by the datasets fingerprint
+        kwargs = dict(
+            pad_values={"input_ids": self.tokenizer.pad_token_id},
+            padding_side=self.tokenizer.padding_side,
+        )
+        if not self.cache.enabled:
+            return TokenStore.from_dataset(dataset, **kwargs)
+        path = os.path.join(self.cache.cache_dir, "token_store", dataset._fingerprint)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            TokenStore.from_dataset(dataset).save(path)
+        return TokenStore.load(path, **kwargs)
+
+    def build_dataloader(self, dataset, batch_size=None, shuffle=False, batch_sampler=None):
+        # every loader of a task goes through here so worker/pinning options apply everywhere
+        kwargs = dataloader_kwargs(self.train_args)
+        if kwargs["num_workers"] > 0:
+            split_intra_op_threads(kwargs["num_workers"])
+        collate_fn = self.data_collator
+        # token_store: serve batches from flat memory-mapped token arrays, see `TokenStore`
+        if getattr(self.train_args, "token_store", False) and not isinstance(dataset, IterableDataset):
+            dataset = self.token_store(dataset)
+            collate_fn = TokenStore.collate
+        if batch_sampler is not None:
+            return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **kwargs)
+        return DataLoader(
+            dataset,
+            shuffle=shuffle,
+            collate_fn=collate_fn,
+            batch_size=batch_size,
+            **kwargs,
+        )
+
+    def train_dataloader(self, dataset):
+        # max_tokens: padded-token budget per batch, replaces train_batch when set
+        if getattr(self.train_args, "max_tokens", None):
+            batch_sampler = TokenBudgetBatchSampler(
+                sequence_lengths(dataset),
+                max_tokens=self.train_args.max_tokens,
+                max_batch_size=getattr(self.train_args, "max_batch_size", None),
+                bucket_size_multiplier=getattr(self.train_args, "bucket_size_multiplier", 100),
+                seed=getattr(self.train_args, "seed", 42),
+            )
+            return self.build_dataloader(dataset, batch_sampler=batch_sampler)
+        # train_sampler: None (uniform shuffle) | "bucket" (length-bucketed shuffle)
+        if getattr(self.train_args, "train_sampler", None) == "bucket":
+            batch_sampler = BucketBatchSampler(
+                sequence_lengths(dataset),
+                batch_size=self.train_args.train_batch,
+                bucket_size_multiplier=getattr(self.train_args, "bucket_size_multiplier", 100),
+                seed=getattr(self.train_args, "seed", 42),
+            )
+            return self.build_dataloader(dataset, batch_sampler=batch_sampler)
+        # seeded rather than `shuffle=True`, so an interrupted epoch can be resumed
+        batch_sampler = RandomBatchSampler(
+            len(dataset), self.train_args.train_batch, seed=getattr(self.train_args, "seed", 42))
+        return self.build_dataloader(dataset, batch_sampler=batch_sampler)
+
+    def val_dataloader(self, dataset):
+        # val_sampler: "sorted" (default, longest first) | None (falls back to eval_sampler)
+        return self.eval_dataloader(
+            dataset, self.train_args.val_batch, sampler=getattr(self.train_args, "val_sampler", "sorted"))
+
+    def eval_dataloader(self, dataset, batch_size, sampler=None):
+        # eval_max_tokens: padded-token budget per batch, always sorted longest first
+        if getattr(self.train_args, "eval_max_tokens", None):
+            batch_sampler = SortedBatchSampler(
+                sequence_lengths(dataset),
+                batch_size=getattr(self.train_args, "max_batch_size", None),
+                max_tokens=self.train_args.eval_max_tokens,
+            )
+            return self.build_dataloader(dataset, batch_sampler=batch_sampler)
+        # eval_sampler: None (dataset order) | "sorted" (longest first, see `restore_order`)
+        if (sampler or getattr(self.train_args, "eval_sampler", None)) == "sorted":
+            batch_sampler = SortedBatchSampler(sequence_lengths(dataset), batch_size)
+            return self.build_dataloader(dataset, batch_sampler=batch_sampler)
+        return self.build_dataloader(dataset, batch_size=batch_size)
+
     def print_model_params(self):
         trainable_params = 0
         total_params = 0
@@ -69,6 +265,7 @@ class TaskClass:
 
 @register_to(TASK_REGISTRY)
 class SQuADv2(TaskClass):
+    process_helpers = (to_list_array, first_answer_char_spans, label_answer_spans)
 
     def __init__(self, task_args, train_args, model_fn):
         super().__init__(task_args, train_args, model_fn)
@@ -78,58 +275,54 @@ class SQuADv2(TaskClass):
         # Expected format: {'predictions': {'id': Value(dtype='string', id=None), 'prediction_text': Value(dtype='string', id=None), 'no_answer_probability': Value(dtype='float32', id=None)}, 'references': {'id': Value(dtype='string', id=None), 'answers': Sequence(feature={'text': Value(dtype='string', id=None), 'answer_start': Value(dtype='int32', id=None)}, length=-1, id=None)}},
 
     @staticmethod
-    def process_function(examples, tokenizer, max_seq_len=384):
-        questions = [q.strip() for q in examples["question"]]
-        
+    def process_function(examples, tokenizer, max_seq_len=384, doc_stride=128, keep_offsets=False):
+        # `examples` is an arrow batch. Contexts that don't fit in max_seq_len are split into
+        # several windows (features) sharing `doc_stride` tokens with their neighbour, so answers
+        # past the cutoff are kept. Features are never padded here: the answer spans are
+        # labelled with array ops over the concatenated tokens of the whole batch and
+        # DataCollatorWithPadding pads each training batch to its longest member.
+        questions = pc.utf8_trim_whitespace(examples["question"]).to_pylist()
+
         inputs = tokenizer(
             questions,
-            examples["context"],
+            examples["context"].to_pylist(),
             max_length=max_seq_len,
-            truncation=True if max_seq_len <= 512 else "only_second",
+            truncation="only_second",
+            stride=doc_stride,
+            return_overflowing_tokens=True,
             return_offsets_mapping=True,
-            padding="max_length",
-        )
-
-        offset_mapping = inputs.pop("offset_mapping")
-        answers = examples["answers"]
-        start_positions = []
-        end_positions = []
-
-        for i, offset in enumerate(offset_mapping):
-            answer = answers[i]
-            if len(answer["answer_start"]) == 0:
-                start_positions.append(0)
-                end_positions.append(0)
-            else:
-                start_char = answer["answer_start"][0]
-                end_char = answer["answer_start"][0] + len(answer["text"][0])
-                sequence_ids = inputs.sequence_ids(i)
-                # Find the start and end of the context
-                idx = 0
-                while sequence_ids[idx] != 1:
-                    idx += 1
-                context_start = idx
-                while sequence_ids[idx] == 1:
-                    idx += 1
-                context_end = idx - 1
-                # If the answer is not fully inside the context, label it (0, 0)
-                if offset[context_start][0] > end_char or offset[context_end][1] < start_char:
-                    start_positions.append(0)
-                    end_positions.append(0)
-                else:
-                    # Otherwise it's the start and end token positions
-                    idx = context_start
-                    while idx <= context_end and offset[idx][0] <= start_char:
-                        idx += 1
-                    start_positions.append(idx - 1)
-                    idx = context_end
-                    while idx >= context_start and offset[idx][1] >= end_char:
-                        idx -= 1
-                    end_positions.append(idx + 1)
-
-        inputs["start_positions"] = start_positions
-        inputs["end_positions"] = end_positions
-        return inputs
+            return_attention_mask=False,
+        )
+        # feature -> index of the example it was cut from
+        sample_mapping = np.asarray(inputs["overflow_to_sample_mapping"], dtype=np.int64)
+
+        input_ids = to_list_array(inputs["input_ids"])
+        lengths = np.diff(input_ids.offsets.to_numpy())
+        token_offsets = np.fromiter(
+            chain.from_iterable(chain.from_iterable(inputs["offset_mapping"])),
+            dtype=np.int64, count=2 * len(input_ids.values),
+        ).reshape(-1, 2)
+        # None (special tokens) becomes NaN
+        sequence_ids = np.array(
+            list(chain.from_iterable(e.sequence_ids for e in inputs.encodings)), dtype=np.float32)
+
+        start_chars, end_chars = first_answer_char_spans(examples["answers"])
+        start_positions, end_positions = label_answer_spans(
+            token_offsets, sequence_ids, lengths, start_chars[sample_mapping], end_chars[sample_mapping])
+
+        features = {
+            "input_ids": input_ids,
+            "start_positions": start_positions,
+            "end_positions": end_positions,
+        }
+        if keep_offsets:
+            # what `postprocess_qa_predictions` needs to map logits back to answer text:
+            # the example of every feature and the offsets of its context tokens (None elsewhere)
+            features["example_id"] = pc.take(examples["id"], sample_mapping)
+            context_offsets = pa.FixedSizeListArray.from_arrays(
+                pa.array(token_offsets.ravel()), 2, mask=pa.array(sequence_ids != 1))
+            features["offset_mapping"] = pa.ListArray.from_arrays(input_ids.offsets, context_offsets)
+        return pa.table(features)
 
     def init_model(self, model_fn, task_args):
         if getattr(task_args, "lora_r") is None or getattr(self.train_args, "from_hf", None):
@@ -141,27 +334,48 @@ class SQuADv2(TaskClass):
                 lora_alpha=task_args.lora_alpha,
             )
 
-    def prepare(self):
-        squad = load_dataset("rajpurkar/squad_v2")
-        # GENE: process_function has 3 params so we need an additional wrapper for max_seq_len
-        process_with_params = partial(self.process_function, tokenizer=self.tokenizer, max_seq_len=self.train_args.max_seq_len)
-        tokenized_squad = squad.map(
-            lambda x: process_with_params(x),
-            batched=True,
-            remove_columns=squad["train"].column_names,
-        )
-        train_dataloader = DataLoader(
-            tokenized_squad['train'],
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_squad['validation'],
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
+    def tokenized_split(self, split):
+        doc_stride = getattr(self.train_args, "doc_stride", 128)
+        # validation features keep what post-processing needs to recover the answer text
+        keep_offsets = split != "train"
+
+        def build():
+            squad = load_dataset("rajpurkar/squad_v2", split=split)
+            # GENE: process_function has 3 params so we need an additional wrapper for max_seq_len
+            process_with_params = partial(
+                self.process_function,
+                tokenizer=self.tokenizer,
+                max_seq_len=self.train_args.max_seq_len,
+                doc_stride=doc_stride,
+                keep_offsets=keep_offsets,
+            )
+            return squad.with_format("arrow").map(
+                process_with_params,
+                batched=True,
+                num_proc=num_proc(self.train_args),
+                remove_columns=squad.column_names,
+            ).with_format(None)
+
+        key = self.cache_key(
+            split,
+            doc_stride=doc_stride,
+            keep_offsets=keep_offsets,
         )
+        return self.cache.load_or_build(key, build, f"SQuADv2/{split}")
+
+    def dataset_splits(self):
+        return ["train", "validation"]
+
+    def prepare(self):
+        tokenized_squad = {
+            split: self.tokenized_split(split) for split in self.dataset_splits()
+        }
+        self.cache.report()
+        self.validation_examples = load_dataset("rajpurkar/squad_v2", split="validation")
+        self.validation_features = tokenized_squad['validation']
+        train_dataloader = self.train_dataloader(tokenized_squad['train'])
+        validation_dataloader = self.val_dataloader(
+            tokenized_squad['validation'].remove_columns(["example_id", "offset_mapping"]))
         # test_dataloader = DataLoader(
         #     tokenized_squad['test'],
         #     shuffle=False,
@@ -179,15 +393,16 @@ class SQuADv2(TaskClass):
         # targ.shape == (bsz)
         return hypo.loss
 
-    def extract_answer_from_output(self, outp):
-        # Extracts the most probable start and end logits from the output
-        logit_ans = torch.stack([
-                        outp.start_logits.argmax(dim=1),
-                        outp.end_logits.argmax(dim=1)
-                    ], dim=1).tolist()
-        return logit_ans
+    @staticmethod
+    def extract_answer_from_output(outp):
+        # Keeps the start and end logits of every feature, the answer text is only decided in
+        # `compute_metric` once all windows of an example have been seen
+        start_logits = outp.start_logits.detach().float().cpu().numpy()
+        end_logits = outp.end_logits.detach().float().cpu().numpy()
+        return list(zip(start_logits, end_logits))
 
-    def extract_label_from_input(self, inp):
+    @staticmethod
+    def extract_label_from_input(inp):
         # Extracts the actual start and end logits from the input
         label_ans = torch.stack([
                         inp['start_positions'],
@@ -195,19 +410,43 @@ class SQuADv2(TaskClass):
                     ], dim=1).tolist()
         return label_ans
 
-    def compute_metric(self, preds, labels):
-        exact_scores = sum([1 if p[0] == a[0] and p[1] == a[1] else 0 for p, a in zip(preds, labels)])
-        
-        # FIX f1_scores
-        f1_scores = [1 if p[0] == a[0] and p[1] == a[1] else 0 for p, a in zip(preds, labels)]
-        average_f1 = sum(f1_scores) / len(f1_scores)
-
-        metric = {
-            "exact_scores": exact_scores,
-            "f1_scores": average_f1
-        }
-        
-        return metric
+    def validation_subsample(self, size):
+        # stratified by answerable / unanswerable over the examples, every window of a chosen
+        # example is kept so the answer can still be decided across its features
+        answerable = [len(answers["text"]) > 0 for answers in self.validation_examples["answers"]]
+        example_indices = stratified_subsample(answerable, size, getattr(self.train_args, "seed", 42))
+        examples = self.validation_examples.select(example_indices)
+        feature_indices = np.flatnonzero(pc.is_in(
+            self.validation_features.with_format("arrow")["example_id"],
+            value_set=pa.array(examples["id"]),
+        ).to_numpy(zero_copy_only=False))
+        features = self.validation_features.select(feature_indices)
+        dataloader = self.val_dataloader(features.remove_columns(["example_id", "offset_mapping"]))
+        return dataloader, partial(self.compute_metric, examples=examples, features=features)
+
+    def compute_metric(self, preds, labels, examples=None, features=None):
+        # preds: (start_logits, end_logits) of every feature of `features`, in dataset order
+        examples = self.validation_examples if examples is None else examples
+        features = self.validation_features if features is None else features
+        predictions, _ = postprocess_qa_predictions(
+            examples,
+            features,
+            ([p[0] for p in preds], [p[1] for p in preds]),
+            version_2_with_negative=True,
+            n_best_size=getattr(self.train_args, "n_best_size", 20),
+            max_answer_length=getattr(self.train_args, "max_answer_length", 30),
+        )
+
+        exact_scores = {}
+        f1_scores = {}
+        for example_id, answers in zip(examples["id"], examples["answers"]):
+            # unanswerable questions only accept the empty answer
+            gold_answers = [a for a in answers["text"] if normalize_answer(a)] or [""]
+            prediction = predictions[example_id]
+            exact_scores[example_id] = max(compute_exact(a, prediction) for a in gold_answers)
+            f1_scores[example_id] = max(compute_f1(a, prediction) for a in gold_answers)
+
+        return dict(self.metric(exact_scores, f1_scores))
 
     def inference(self, inp):
         outp = self.model(**inp)
@@ -218,6 +457,14 @@ class SQuADv2(TaskClass):
         return pred, label.detach().tolist()
 
 class SequenceClassification(TaskClass):
+    dataset_path = "nyu-mll/glue"
+    process_helpers = (to_list_array,)
+    # subclasses define the text columns fed to the tokenizer
+    input_fields = None
+    num_labels = 2
+    train_split = "train"
+    validation_split = "validation"
+    test_split = "test"
 
     def __init__(self, task_args, train_args, model_fn):
         super().__init__(task_args, train_args, model_fn)
@@ -226,49 +473,160 @@ class SequenceClassification(TaskClass):
 
     def init_model(self, model_fn, task_args):
         if getattr(task_args, "lora_r", None) is None or getattr(self.train_args, "from_hf", None):
-            self.model = model_fn(task_args.model_name, num_labels=2)
+            self.model = model_fn(task_args.model_name, num_labels=self.num_labels)
         else:
             self.model = model_fn(
                 task_args.model_name,
                 lora_r=task_args.lora_r,
                 lora_alpha=task_args.lora_alpha,
-                num_labels=2
+                num_labels=self.num_labels
             )
 
     @staticmethod
     def process_function(examples, tokenizer, input_fields, max_seq_len=None):
+        # `examples` is an arrow batch: whitespace is stripped in arrow and the token ids go back
+        # as flat int32 arrays + offsets, skipping the per-example python lists in `datasets`.
+        # attention_mask is not stored, DataCollatorWithPadding rebuilds it while padding.
         max_seq_len = 384 if max_seq_len is None else max_seq_len
-        if len(input_fields) == 1:
-            inp = tokenizer(
-                [i.strip() for i in examples[input_fields[0]]],
-                max_length=max_seq_len,
-                truncation=True,
+        texts = [pc.utf8_trim_whitespace(examples[field]).to_pylist() for field in input_fields]
+        inp = tokenizer(
+            *texts,
+            max_length=max_seq_len,
+            truncation=True,
+            return_attention_mask=False,
+        )
+        # the arrow batch returned replaces the input batch, so carry over 'label', 'idx', ...
+        columns = {name: examples[name] for name in examples.column_names if name not in input_fields}
+        columns.update({key: to_list_array(value) for key, value in inp.items()})
+        return pa.table(columns)
+
+    def dataset_splits(self):
+        return [self.train_split, self.validation_split, self.test_split]
+
+    def tokenized_split(self, split):
+        # tokenized splits keep 'label' and 'idx' next to the model inputs
+        def build():
+            ds = load_dataset(self.dataset_path, self.task_args.task_name.lower(), split=split)
+            process = partial(
+                self.process_function,
+                tokenizer=self.tokenizer,
+                input_fields=self.input_fields,
+                max_seq_len=getattr(self.train_args, "max_seq_len", None),
             )
-        else:
-            inp = tokenizer(
-                [i.strip() for i in examples[input_fields[0]]],
-                [i.strip() for i in examples[input_fields[1]]],
-                max_length=max_seq_len,
-                truncation=True,   
+            return ds.with_format("arrow").map(
+                process,
+                batched=True,
+                batch_size=10000,
+                num_proc=num_proc(self.train_args),
+                remove_columns=self.input_fields,
+            ).with_format(None)
+        key = self.cache_key(split, input_fields=self.input_fields)
+        return self.cache.load_or_build(key, build, f"{type(self).__name__}/{split}")
+
+    def streaming_split(self, split, columns, shuffle=False):
+        # read and tokenized lazily while training, nothing goes through the tokenization cache
+        ds = load_dataset(self.dataset_path, self.task_args.task_name.lower(), split=split, streaming=True)
+        split_info = ds.info.splits.get(split) if ds.info.splits else None
+        process = partial(
+            self.process_function,
+            tokenizer=self.tokenizer,
+            input_fields=self.input_fields,
+            max_seq_len=getattr(self.train_args, "max_seq_len", None),
+        )
+        return StreamingDataset(
+            ds.with_format("arrow"),
+            process,
+            columns=columns,
+            length=split_info.num_examples if split_info is not None else None,
+            shuffle_buffer=getattr(self.train_args, "shuffle_buffer", 10000) if shuffle else 0,
+            chunk_size=getattr(self.train_args, "streaming_chunk_size", 1000),
+            seed=getattr(self.train_args, "seed", 42),
+        )
+
+    def prepare_streaming(self):
+        train_dataloader = self.build_dataloader(
+            self.streaming_split(self.train_split, ["input_ids", "label"], shuffle=True),
+            batch_size=self.train_args.train_batch,
+        )
+        validation_dataloader = self.build_dataloader(
+            self.streaming_split(self.validation_split, ["input_ids", "label"]),
+            batch_size=self.train_args.val_batch,
+        )
+        # test batches carry their own 'idx', see `CustomTrainer.evaluate`
+        self.test_idx = None
+        test_dataloader = self.build_dataloader(
+            self.streaming_split(self.test_split, ["input_ids", "label", "idx"]),
+            batch_size=self.train_args.test_batch,
+        )
+        return (
+            train_dataloader,
+            validation_dataloader,
+            test_dataloader,
+        )
+
+    def prepare_eval(self):
+        if getattr(self.train_args, "streaming", False):
+            # test batches carry their own 'idx', see `CustomEvaluator.evaluate`
+            self.test_idx = None
+            return self.build_dataloader(
+                self.streaming_split(self.test_split, ["input_ids", "idx"]),
+                batch_size=self.train_args.test_batch,
             )
-        inp["label"] = examples["label"]
-        return inp
+
+        tokenized_ds = self.tokenized_split(self.test_split)
+        self.cache.report()
+        self.test_idx = tokenized_ds.with_format("arrow")['idx'].to_numpy()
+        test_dataloader = self.eval_dataloader(
+            tokenized_ds.remove_columns(["label", "idx"]), self.train_args.test_batch)
+        return test_dataloader
+
+    def prepare(self):
+        if getattr(self.train_args, "streaming", False):
+            return self.prepare_streaming()
+
+        tokenized_train = self.tokenized_split(self.train_split)
+        tokenized_validation = self.tokenized_split(self.validation_split)
+        tokenized_test = self.tokenized_split(self.test_split)
+        self.cache.report()
+
+        train_dataloader = self.train_dataloader(tokenized_train.remove_columns(["idx"]))
+        self.validation_features = tokenized_validation.remove_columns(["idx"])
+        validation_dataloader = self.val_dataloader(self.validation_features)
+        # test_idx stays in dataset order, predictions are restored to it in `CustomTrainer.evaluate`
+        self.test_idx = tokenized_test.with_format("arrow")['idx'].to_numpy()
+        test_dataloader = self.eval_dataloader(
+            tokenized_test.remove_columns(["idx"]), self.train_args.test_batch)
+        return (
+            train_dataloader,
+            validation_dataloader,
+            test_dataloader,
+        )
 
     def loss_function(self, hypo, targ):
         # hypo.shape == (bsz, num_classes)
         # targ.shape == (bsz)
         return hypo.loss
 
-    def extract_answer_from_output(self, outp):
+    @staticmethod
+    def extract_answer_from_output(outp):
+        # static, so it can be sent to the background test inference process
         return outp.logits.argmax(dim=1).detach().tolist()
 
-    def extract_label_from_input(self, inp):
+    @staticmethod
+    def extract_label_from_input(inp):
         return inp['labels'].detach().tolist()
 
     def inference(self, inp):
         outp = self.model(**inp)
         return self.extract_answer_from_output(outp)
 
+    def validation_subsample(self, size):
+        if getattr(self.train_args, "streaming", False):
+            raise NotImplementedError("no validation subsample for streaming datasets")
+        labels = self.validation_features.with_format("arrow")["label"].to_numpy()
+        indices = stratified_subsample(labels, size, getattr(self.train_args, "seed", 42))
+        return self.val_dataloader(self.validation_features.select(indices)), self.compute_metric
+
     def compute_metric(self, preds, labels):
         return self.metric.compute(
             predictions=preds,
@@ -281,478 +639,74 @@ class SequenceClassification(TaskClass):
 
 @register_to(TASK_REGISTRY)
 class MNLI(SequenceClassification):
-
-    def init_model(self, model_fn, task_args):
-        if getattr(task_args, "lora_r") is None or getattr(self.train_args, "from_hf", None):
-            self.model = model_fn(task_args.model_name, num_labels=3)
-        else:
-            self.model = model_fn(
-                task_args.model_name,
-                lora_r=task_args.lora_r,
-                lora_alpha=task_args.lora_alpha,
-                num_labels=3
-            )
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test_matched")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-            x, self.tokenizer, ["premise", "hypothesis"], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_matched_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_matched_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ["premise", "hypothesis"], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            # remove_columns=ds["train"].column_names,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_matched_dataloader = DataLoader(
-            tokenized_ds['validation_matched'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test_matched']['idx']
-        test_matched_dataloader = DataLoader(
-            tokenized_ds['test_matched'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation_matched", "test_matched"
-        # ['premise', 'hypothesis', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1, 2
-        return (
-            train_dataloader,
-            validation_matched_dataloader,
-            test_matched_dataloader,
-        )
+    # "train", "validation_matched", "test_matched"
+    # ['premise', 'hypothesis', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1, 2
+    input_fields = ["premise", "hypothesis"]
+    num_labels = 3
+    validation_split = "validation_matched"
+    test_split = "test_matched"
 
 @register_to(TASK_REGISTRY)
 class SST2(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ["sentence"], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ["sentence"], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['sentence', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # stanford sentiment treebank (sst2) tests for sentiment (pos/neg) of given sentence
-
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['sentence', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # stanford sentiment treebank (sst2) tests for sentiment (pos/neg) of given sentence
+    input_fields = ["sentence"]
 
 @register_to(TASK_REGISTRY)
 class MRPC(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['sentence1', 'sentence2', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # microsoft research paraphrase corpus (mrpc)mtests for semantic equivalence 
-
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['sentence1', 'sentence2', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # microsoft research paraphrase corpus (mrpc)mtests for semantic equivalence 
+    input_fields = ['sentence1', 'sentence2']
 
 @register_to(TASK_REGISTRY)
 class CoLA(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['sentence', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # tests whether the given sentence is grammatically correct english
-
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['sentence', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # tests whether the given sentence is grammatically correct english
+    input_fields = ['sentence']
 
 @register_to(TASK_REGISTRY)
 class QNLI(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['question', 'sentence'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['question', 'sentence'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['question', 'sentence', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # tests for whether the answer to the question can be found in the question
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['question', 'sentence', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # tests for whether the answer to the question can be found in the question
+    input_fields = ['question', 'sentence']
 
 @register_to(TASK_REGISTRY)
 class QQP(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['question1', 'question2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['question1', 'question2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['question1', 'question2', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # quora question pairs (qqp) tests for semantic equivalence 
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['question1', 'question2', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # quora question pairs (qqp) tests for semantic equivalence 
+    input_fields = ['question1', 'question2']
 
 @register_to(TASK_REGISTRY)
 class RTE(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['sentence1', 'sentence2', 'label', 'idx']
-        # task: SequenceClassification
-        # label: 0, 1
-        # recognizing textual entailment (rte) tests textual entailment (collapses neutral & contradiction into not entailment)
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['sentence1', 'sentence2', 'label', 'idx']
+    # task: SequenceClassification
+    # label: 0, 1
+    # recognizing textual entailment (rte) tests textual entailment (collapses neutral & contradiction into not entailment)
+    input_fields = ['sentence1', 'sentence2']
 
 @register_to(TASK_REGISTRY)
 class STSB(SequenceClassification):
-
-    def prepare_eval(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower(), split="test")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-            remove_columns=ds.column_names,
-        )
-        test_dataloader = DataLoader(
-            tokenized_ds,
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        return test_dataloader
-
-    def prepare(self):
-        ds = load_dataset("nyu-mll/glue", self.task_args.task_name.lower())
-        column_names = ds["train"].column_names
-        column_names.remove("label")
-        tokenized_ds = ds.map(
-            lambda x: self.process_function(
-                x, self.tokenizer, ['sentence1', 'sentence2'], getattr(self.train_args, "max_seq_len", None)),
-            batched=True,
-        )
-        train_dataloader = DataLoader(
-            tokenized_ds['train'].remove_columns(column_names),
-            shuffle=True,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.train_batch,
-        )
-        validation_dataloader = DataLoader(
-            tokenized_ds['validation'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.val_batch,
-        )
-        self.test_idx = tokenized_ds['test']['idx']
-        test_dataloader = DataLoader(
-            tokenized_ds['test'].remove_columns(column_names),
-            shuffle=False,
-            collate_fn=self.data_collator,
-            batch_size=self.train_args.test_batch,
-        )
-        # "train", "validation", "test"
-        # ['sentence1', 'sentence2', 'label', 'idx']
-        # task: SequenceClassification
-        # label: floating point from 0 to 5
-        # pair is human-annotated with a similarity score from 1 to 5
-        return (
-            train_dataloader,
-            validation_dataloader,
-            test_dataloader,
-        )
+    # "train", "validation", "test"
+    # ['sentence1', 'sentence2', 'label', 'idx']
+    # task: SequenceClassification
+    # label: floating point from 0 to 5
+    # pair is human-annotated with a similarity score from 1 to 5
+    input_fields = ['sentence1', 'sentence2']
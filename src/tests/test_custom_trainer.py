@@ -0,0 +1,42 @@
+import torch
+from accelerate import Accelerator
+from torch.utils.data import DataLoader
+
+from custom_classes.custom_trainer import CustomTrainer, EarlyStopping, resume_position
+
+# Run from `src/`: python3 -m pytest tests
+
+
+def trainer_with_checkpoint(checkpoint_path, epoch, step):
+    trainer = CustomTrainer.__new__(CustomTrainer)
+    trainer.accelerator = Accelerator(cpu=True)
+    trainer.early_stopping = EarlyStopping()
+    trainer.train_dl = DataLoader(list(range(8)), batch_size=2)
+    model = torch.nn.Linear(2, 2)
+    optimizer = torch.optim.AdamW(model.parameters())
+    scheduler = torch.optim.lr_scheduler.LinearLR(optimizer)
+    torch.save({
+        'epoch': epoch,
+        'step': step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'sampler_state_dict': None,
+        'rng_state': torch.get_rng_state(),
+        'early_stopping_state_dict': trainer.early_stopping.state_dict(),
+    }, checkpoint_path / f"epoch_{epoch}_step_{step}.pt")
+    return trainer, model, optimizer, scheduler
+
+
+def test_resume_from_end_of_epoch_checkpoint(tmp_path):
+    trainer, model, optimizer, scheduler = trainer_with_checkpoint(tmp_path, epoch=1, step=4)
+    epoch, step = trainer.load_checkpoint(str(tmp_path), model, optimizer, scheduler)
+    assert (epoch, step) == (1, 4)
+    # all 4 batches of epoch 1 are done: no validation, checkpoint or test predictions of epoch 1 again
+    assert resume_position(epoch, step, len(trainer.train_dl)) == (2, 0)
+
+
+def test_resume_mid_epoch_checkpoint(tmp_path):
+    trainer, model, optimizer, scheduler = trainer_with_checkpoint(tmp_path, epoch=1, step=3)
+    epoch, step = trainer.load_checkpoint(str(tmp_path), model, optimizer, scheduler)
+    assert resume_position(epoch, step, len(trainer.train_dl)) == (1, 3)
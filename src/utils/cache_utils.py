@@ -0,0 +1,75 @@
+import copy
+
+import torch
+
+
+class ResourceCache:
+    '''Process-wide cache of what consecutive runs in one process can share, e.g. sweep trials
+
+    Off until `enable` is called. Entries are built once by `get(key, build)`: tokenizers,
+    tokenized splits (see `TokenizationCache`) and pristine pretrained models (see
+    `pretrained_model`). Building an entry can draw from the torch RNG (the random head
+    of a pretrained model), so the RNG state after the build is kept and replayed on a hit
+    that starts from the same state, which keeps cached runs identical to uncached ones.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return self.enabled and key in self.entries
+
+    def get(self, key, build):
+        if not self.enabled:
+            return build()
+        rng_state = torch.get_rng_state()
+        if key in self.entries:
+            self.hits += 1
+            value, rng_before, rng_after = self.entries[key]
+            if torch.equal(rng_state, rng_before):
+                torch.set_rng_state(rng_after)
+            return value
+        self.misses += 1
+        value = build()
+        self.entries[key] = (value, rng_state, torch.get_rng_state())
+        return value
+
+    def report(self):
+        print(f"Resource cache: {self.hits} hits | {self.misses} misses")
+
+
+RESOURCE_CACHE = ResourceCache()
+
+
+def share_frozen_copy(model):
+    '''Copy of `model` whose parameters are new `Parameter`s over the same tensors
+
+    For models that only train added modules (LoRA adapters, a copied head): the copy can be
+    wrapped, frozen and trained without changing `model`, and the weights aren't duplicated.
+    '''
+    memo = {id(param): torch.nn.Parameter(param.data, requires_grad=param.requires_grad)
+            for param in model.parameters()}
+    return copy.deepcopy(model, memo)
+
+
+def pretrained_model(auto_class, model_name, frozen=False, **kwargs):
+    '''`auto_class.from_pretrained(model_name, **kwargs)`, with the pretrained weights shared when `frozen`
+
+    With `frozen` (the caller only trains modules it adds on top, e.g. LoRA) and the cache
+    on, the model is loaded once per process and every call gets a copy over the same
+    tensors (see `share_frozen_copy`). Models that train every weight are loaded again,
+    which with memory-mapped safetensors is faster than copying a cached one.
+    '''
+    if not (frozen and RESOURCE_CACHE.enabled):
+        return auto_class.from_pretrained(model_name, **kwargs)
+    key = ("pretrained", auto_class.__name__, model_name, tuple(sorted(kwargs.items())))
+    return share_frozen_copy(RESOURCE_CACHE.get(key, lambda: auto_class.from_pretrained(model_name, **kwargs)))
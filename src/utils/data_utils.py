@@ -0,0 +1,88 @@
+import os
+from itertools import chain
+
+import numpy as np
+import pyarrow as pa
+import torch
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_init_fn(worker_id):
+    # collation is single-threaded work, leave the cores to the training process
+    torch.set_num_threads(1)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+def split_intra_op_threads(num_workers):
+    '''Shrink the training process' intra-op pool so it and the loader workers fit on the cores'''
+    threads = max(1, available_cores() - num_workers)
+    if torch.get_num_threads() > threads:
+        print(f"Using {threads} intra-op threads next to {num_workers} dataloader workers")
+        torch.set_num_threads(threads)
+
+
+def dataloader_kwargs(args):
+    '''DataLoader worker/pinning options read from a config class
+
+    num_workers (default 0), persistent_workers (default True with workers),
+    prefetch_factor (default torch's) and pin_memory (default: only with cuda).
+    The loader gets its own generator seeded with `seed`, so iterating it never
+    draws from the global RNG (used by dropout) and resumed runs stay in step.
+    '''
+    num_workers = getattr(args, "num_workers", 0) or 0
+    kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": getattr(args, "pin_memory", torch.cuda.is_available()),
+        "generator": torch.Generator().manual_seed(getattr(args, "seed", 42)),
+    }
+    if num_workers > 0:
+        kwargs["persistent_workers"] = getattr(args, "persistent_workers", True)
+        kwargs["worker_init_fn"] = worker_init_fn
+        if getattr(args, "prefetch_factor", None) is not None:
+            kwargs["prefetch_factor"] = args.prefetch_factor
+    return kwargs
+
+
+def num_proc(args):
+    '''Processes for `datasets.map`, None keeps preprocessing in this process'''
+    n = getattr(args, "num_proc", None)
+    return n if n is not None and n > 1 else None
+
+
+def stratified_subsample(labels, size, seed=42, bins=10):
+    '''Sorted indices of a fixed random subsample with the label proportions of `labels`
+
+    `size` is a number of examples or, if below 1, a fraction. Float labels (regression)
+    are stratified by `bins` quantile bins.
+    '''
+    labels = np.asarray(labels)
+    size = int(round(size * len(labels))) if size < 1 else min(int(size), len(labels))
+    if np.issubdtype(labels.dtype, np.floating):
+        labels = np.digitize(labels, np.quantile(labels, np.linspace(0, 1, bins + 1)[1:-1]))
+    classes, counts = np.unique(labels, return_counts=True)
+    # largest remainder allocation of `size` over the classes
+    quotas = counts * size / len(labels)
+    per_class = np.floor(quotas).astype(np.int64)
+    per_class[np.argsort(per_class - quotas)[:size - per_class.sum()]] += 1
+
+    rng = np.random.default_rng(seed)
+    indices = [
+        rng.choice(np.flatnonzero(labels == label), n, replace=False)
+        for label, n in zip(classes, per_class)
+    ]
+    return np.sort(np.concatenate(indices))
+
+
+def to_list_array(sequences, dtype=np.int32):
+    '''Ragged python lists -> arrow list array, built from one flat numpy buffer + offsets'''
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter(chain.from_iterable(sequences), dtype=dtype, count=int(offsets[-1]))
+    return pa.ListArray.from_arrays(offsets, values)
+
@@ -3,52 +3,124 @@ import collections
 from typing import Optional, Tuple
 
 import numpy as np
-from tqdm.auto import tqdm
-
-def prepare_validation_features(examples, tokenizer):
-    # Some of the questions have lots of whitespace on the left, which is not useful and will make the
-    # truncation of the context fail (the tokenized question will take a lots of space). So we remove that
-    # left whitespace
-    examples["question"] = [q.lstrip() for q in examples["question"]]
-    pad_on_right = tokenizer.padding_side == "right"
-    # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
-    # in one example possible giving several features when a context is long, each of those features having a
-    # context that overlaps a bit the context of the previous feature.
-    tokenized_examples = tokenizer(
-        examples["question" if pad_on_right else "context"],
-        examples["context" if pad_on_right else "question"],
-        truncation="only_second" if pad_on_right else "only_first",
-        max_length=max_length,
-        stride=doc_stride,
-        return_overflowing_tokens=True,
-        return_offsets_mapping=True,
-        padding="max_length",
-    )
-
-    # Since one example might give us several features if it has a long context, we need a map from a feature to
-    # its corresponding example. This key gives us just that.
-    sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+import pyarrow as pa
+import pyarrow.compute as pc
 
-    # We keep the example_id that gave us this feature and we will store the offset mappings.
-    tokenized_examples["example_id"] = []
+def first_answer_char_spans(answers):
+    """
+    Character span of the first gold answer of every example in an arrow batch of SQuAD `answers`.
+    Unanswerable examples get (-1, -1).
+    """
+    if isinstance(answers, pa.ChunkedArray):
+        answers = answers.combine_chunks()
+    answer_starts = pc.struct_field(answers, "answer_start")
+    texts = pc.struct_field(answers, "text")
+    # offsets of a (possibly sliced) list array index into its unsliced `values`
+    first = answer_starts.offsets.to_numpy()[:-1]
+    has_answer = pc.list_value_length(answer_starts).to_numpy(zero_copy_only=False) > 0
+
+    start_chars = np.full(len(answers), -1, dtype=np.int64)
+    end_chars = np.full(len(answers), -1, dtype=np.int64)
+    start_values = answer_starts.values.to_numpy()
+    text_lengths = pc.utf8_length(texts.values).to_numpy()
+    text_first = texts.offsets.to_numpy()[:-1]
+    start_chars[has_answer] = start_values[first[has_answer]]
+    end_chars[has_answer] = start_chars[has_answer] + text_lengths[text_first[has_answer]]
+    return start_chars, end_chars
+
+
+def label_answer_spans(token_offsets, sequence_ids, lengths, start_chars, end_chars, context_index=1):
+    """
+    Start/end token positions of the answers for a whole batch of unpadded features at once.
 
-    for i in range(len(tokenized_examples["input_ids"])):
-        # Grab the sequence corresponding to that example (to know what is the context and what is the question).
-        sequence_ids = tokenized_examples.sequence_ids(i)
-        context_index = 1 if pad_on_right else 0
+    Args:
+        token_offsets: (num_tokens, 2) character offsets of the tokens of all features, concatenated.
+        sequence_ids: (num_tokens,) sequence index of every token, NaN for special tokens.
+        lengths: (num_features,) number of tokens of every feature.
+        start_chars, end_chars: (num_features,) character span of the answer, -1 for unanswerable features.
+
+    Features whose answer is missing or not fully inside their context are labelled (0, 0). Offsets
+    inside the context are non-decreasing, so the token loops of the reference implementation reduce
+    to counting the context tokens on either side of the answer, one `reduceat` per quantity.
+    """
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(len(sequence_ids)) - starts[rows]
+    is_context = sequence_ids == context_index
+    token_starts = token_offsets[:, 0]
+    token_ends = token_offsets[:, 1]
+
+    has_context = np.add.reduceat(is_context, starts) > 0
+    context_start = np.minimum.reduceat(np.where(is_context, positions, np.iinfo(np.int64).max), starts)
+    context_end = np.maximum.reduceat(np.where(is_context, positions, -1), starts)
+    context_start = np.where(has_context, context_start, 0)
+    context_end = np.where(has_context, context_end, 0)
+
+    inside = (
+        (start_chars >= 0)
+        & has_context
+        & (token_starts[starts + context_start] <= start_chars)
+        & (token_ends[starts + context_end] >= end_chars)
+    )
+    tokens_before = np.add.reduceat(is_context & (token_starts <= start_chars[rows]), starts)
+    tokens_after = np.add.reduceat(is_context & (token_ends >= end_chars[rows]), starts)
+    start_positions = context_start + tokens_before - 1
+    end_positions = context_end - tokens_after + 1
+    return np.where(inside, start_positions, 0), np.where(inside, end_positions, 0)
 
-        # One example can give several spans, this is the index of the example containing this span of text.
-        sample_index = sample_mapping[i]
-        tokenized_examples["example_id"].append(examples["id"][sample_index])
 
-        # Set to None the offset_mapping that are not part of the context so it's easy to determine if a token
-        # position is part of the context or not.
-        tokenized_examples["offset_mapping"][i] = [
-            (o if sequence_ids[k] == context_index else None)
-            for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-        ]
+def padded_logits(logits, seq_len, fill_value=-np.inf):
+    """
+    Stacks per-feature logits of different lengths (one array per feature, e.g. from dynamically padded
+    batches) into a (num_features, seq_len) array.
+    """
+    if isinstance(logits, np.ndarray) and logits.ndim == 2:
+        padded = np.full((len(logits), seq_len), fill_value, dtype=np.float32)
+        width = min(seq_len, logits.shape[1])
+        padded[:, :width] = logits[:, :width]
+        return padded
+    padded = np.full((len(logits), seq_len), fill_value, dtype=np.float32)
+    for i, row in enumerate(logits):
+        row = np.asarray(row)[:seq_len]
+        padded[i, :len(row)] = row
+    return padded
+
+
+def context_offsets(features, seq_len):
+    """
+    (num_features, seq_len) character start/end offsets and context mask, read straight from the arrow
+    `offset_mapping` column of `features` (non-context tokens are null there).
+    """
+    offset_mapping = features.with_format("arrow")["offset_mapping"]
+    if isinstance(offset_mapping, pa.ChunkedArray):
+        offset_mapping = offset_mapping.combine_chunks()
+    lengths = pc.list_value_length(offset_mapping).to_numpy(zero_copy_only=False)
+    tokens = pc.list_flatten(offset_mapping)
+    pairs = tokens.values.slice(tokens.offset * 2, len(tokens) * 2).to_numpy(zero_copy_only=False).reshape(-1, 2)
+    is_context = tokens.is_valid().to_numpy(zero_copy_only=False)
+
+    # tokens past seq_len have no logits and are dropped
+    in_row = np.arange(seq_len) < np.minimum(lengths, seq_len)[:, None]
+    row_starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=row_starts[1:])
+    flat_index = (row_starts[:, None] + np.arange(seq_len)[None, :])[in_row]
+
+    starts = np.zeros((len(lengths), seq_len), dtype=np.int64)
+    ends = np.zeros((len(lengths), seq_len), dtype=np.int64)
+    context = np.zeros((len(lengths), seq_len), dtype=bool)
+    starts[in_row] = pairs[flat_index, 0]
+    ends[in_row] = pairs[flat_index, 1]
+    context[in_row] = is_context[flat_index]
+    return starts, ends, context
+
+
+def column_values(dataset, name):
+    """A whole column as a python list; `datasets.Dataset` columns are read through arrow, not row by row."""
+    if hasattr(dataset, "with_format"):
+        return dataset.with_format("arrow")[name].to_pylist()
+    return list(dataset[name])
 
-    return tokenized_examples
 
 def postprocess_qa_predictions(
     examples,
@@ -58,21 +130,31 @@ def postprocess_qa_predictions(
     n_best_size: int = 20,
     max_answer_length: int = 30,
     null_score_diff_threshold: float = 0.0,
+    chunk_size: int = 4096,
 ):
     """
     Post-processes the predictions of a question-answering model to convert them to answers that are substrings of the
     original contexts. This is the base postprocessing functions for models that only return start and end logits.
 
+    All features are scored at once: the `n_best_size` best start and end positions of every feature come from a
+    partial sort (`np.argpartition`), all start/end pairs are scored as an outer sum and invalid pairs are masked
+    out. The best answer of an example is the best valid pair over all of its features, which is what the n-best
+    list of the reference implementation ends up picking. One difference: a span with an empty text (e.g. a
+    zero-width token) is never the answer. The reference only skips those with :obj:`version_2_with_negative`;
+    without it, it returns "" when such a span scores best.
+
     Args:
         examples: The non-preprocessed dataset (see the main script for more information).
-        features: The processed dataset (see the main script for more information).
+        features: The processed dataset, with `example_id` and `offset_mapping` columns (see
+            `SQuADv2.process_function`).
         predictions (:obj:`Tuple[np.ndarray, np.ndarray]`):
-            The predictions of the model: two arrays containing the start logits and the end logits respectively. Its
-            first dimension must match the number of elements of :obj:`features`.
+            The predictions of the model: start logits and end logits, either two 2D arrays or two sequences of
+            per-feature 1D arrays of any length. Their first dimension must match the number of elements of
+            :obj:`features`.
         version_2_with_negative (:obj:`bool`, `optional`, defaults to :obj:`False`):
             Whether or not the underlying dataset contains examples with no answers.
         n_best_size (:obj:`int`, `optional`, defaults to 20):
-            The total number of n-best predictions to generate when looking for an answer.
+            The number of best start and end positions of each feature that are paired up.
         max_answer_length (:obj:`int`, `optional`, defaults to 30):
             The maximum length of an answer that can be generated. This is needed because the start and end predictions
             are not conditioned on one another.
@@ -81,6 +163,12 @@ def postprocess_qa_predictions(
             the null answer minus this threshold, the null answer is selected for this example (note that the score of
             the null answer for an example giving several features is the minimum of the scores for the null answer on
             each feature: all features must be aligned on the fact they `want` to predict a null answer).
+        chunk_size (:obj:`int`, `optional`, defaults to 4096):
+            Number of features scored together, bounds the memory of the (chunk_size, n_best_size, n_best_size) scores.
+
+    Returns:
+        The predicted text of every example, and the null-score diff of every example (empty unless
+        :obj:`version_2_with_negative`), both keyed by example id.
     """
     if len(predictions) != 2:
         raise ValueError("`predictions` should be a tuple with two elements (start_logits, end_logits).")
@@ -89,142 +177,87 @@ def postprocess_qa_predictions(
     if len(predictions[0]) != len(features):
         raise ValueError(f"Got {len(predictions[0])} predictions and {len(features)} features.")
 
-    # Build a map example to its corresponding features.
-    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
-    features_per_example = collections.defaultdict(list)
-    for i, feature in enumerate(features):
-        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+    seq_len = max(len(logits) for logits in all_start_logits)
+    start_logits = padded_logits(all_start_logits, seq_len)
+    end_logits = padded_logits(all_end_logits, seq_len)
+    token_starts, token_ends, is_context = context_offsets(features, seq_len)
+    k = min(n_best_size, seq_len)
+
+    # Best valid (start, end) pair of every feature.
+    num_features = len(features)
+    best_scores = np.full(num_features, -np.inf, dtype=np.float32)
+    best_starts = np.zeros(num_features, dtype=np.int64)
+    best_ends = np.zeros(num_features, dtype=np.int64)
+    for chunk_start in range(0, num_features, chunk_size):
+        rows = np.arange(chunk_start, min(chunk_start + chunk_size, num_features))
+        start_indexes = np.argpartition(-start_logits[rows], k - 1, axis=1)[:, :k]
+        end_indexes = np.argpartition(-end_logits[rows], k - 1, axis=1)[:, :k]
+        r = rows[:, None]
+        scores = (
+            start_logits[r, start_indexes][:, :, None] + end_logits[r, end_indexes][:, None, :]
+        )
+        s = start_indexes[:, :, None]
+        e = end_indexes[:, None, :]
+        rr = r[:, :, None]
+        valid = (
+            is_context[rr, s]
+            & is_context[rr, e]
+            & (e >= s)
+            & (e - s + 1 <= max_answer_length)
+            # an empty text is never picked as the non-null answer
+            & (token_ends[rr, e] > token_starts[rr, s])
+        )
+        scores = np.where(valid, scores, -np.inf).reshape(len(rows), -1)
+        best = scores.argmax(axis=1)
+        best_scores[rows] = scores[np.arange(len(rows)), best]
+        best_starts[rows] = np.take_along_axis(start_indexes, (best // k)[:, None], axis=1)[:, 0]
+        best_ends[rows] = np.take_along_axis(end_indexes, (best % k)[:, None], axis=1)[:, 0]
+
+    # Map every feature to its example, then reduce over the features of each example.
+    example_ids = column_values(examples, "id")
+    example_id_to_index = {example_id: i for i, example_id in enumerate(example_ids)}
+    feature_examples = np.fromiter(
+        (example_id_to_index[example_id] for example_id in column_values(features, "example_id")),
+        dtype=np.int64, count=num_features,
+    )
+    # primary key: example, then best score first (stable, so ties keep the first feature)
+    order = np.lexsort((-best_scores, feature_examples))
+    group_starts = np.flatnonzero(np.r_[True, np.diff(feature_examples[order]) != 0])
+    grouped_examples = feature_examples[order][group_starts]
+    best_feature = order[group_starts]
+    null_scores = start_logits[:, 0] + end_logits[:, 0]
+    min_null_scores = np.minimum.reduceat(null_scores[order], group_starts)
 
-    # The dictionaries we have to fill.
     all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    if version_2_with_negative:
-        scores_diff_json = collections.OrderedDict()
-
-    # Let's loop over all the examples!
-    for example_index, example in enumerate(tqdm(examples)):
-        # Those are the indices of the features associated to the current example.
-        feature_indices = features_per_example[example_index]
-
-        min_null_prediction = None
-        prelim_predictions = []
-
-        # Looping through all the features associated to the current example.
-        for feature_index in feature_indices:
-            # We grab the predictions of the model for this feature.
-            start_logits = all_start_logits[feature_index]
-            end_logits = all_end_logits[feature_index]
-            # This is what will allow us to map some the positions in our logits to span of texts in the original
-            # context.
-            offset_mapping = features[feature_index]["offset_mapping"]
-            # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
-            # available in the current feature.
-            token_is_max_context = features[feature_index].get("token_is_max_context", None)
-
-            # Update minimum null prediction.
-            feature_null_score = start_logits[0] + end_logits[0]
-            if min_null_prediction is None or min_null_prediction["score"] > feature_null_score:
-                min_null_prediction = {
-                    "offsets": (0, 0),
-                    "score": feature_null_score,
-                    "start_logit": start_logits[0],
-                    "end_logit": end_logits[0],
-                }
-
-            # Go through all possibilities for the `n_best_size` greater start and end logits.
-            start_indexes = np.argsort(start_logits)[-1 : -n_best_size - 1 : -1].tolist()
-            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1].tolist()
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond
-                    # to part of the input_ids that are not in the context.
-                    if (
-                        start_index >= len(offset_mapping)
-                        or end_index >= len(offset_mapping)
-                        or offset_mapping[start_index] is None
-                        or len(offset_mapping[start_index]) < 2
-                        or offset_mapping[end_index] is None
-                        or len(offset_mapping[end_index]) < 2
-                    ):
-                        continue
-                    # Don't consider answers with a length that is either < 0 or > max_answer_length.
-                    if end_index < start_index or end_index - start_index + 1 > max_answer_length:
-                        continue
-                    # Don't consider answer that don't have the maximum context available (if such information is
-                    # provided).
-                    if token_is_max_context is not None and not token_is_max_context.get(str(start_index), False):
-                        continue
-
-                    prelim_predictions.append(
-                        {
-                            "offsets": (offset_mapping[start_index][0], offset_mapping[end_index][1]),
-                            "score": start_logits[start_index] + end_logits[end_index],
-                            "start_logit": start_logits[start_index],
-                            "end_logit": end_logits[end_index],
-                        }
-                    )
-        if version_2_with_negative and min_null_prediction is not None:
-            # Add the minimum null prediction
-            prelim_predictions.append(min_null_prediction)
-            null_score = min_null_prediction["score"]
-
-        # Only keep the best `n_best_size` predictions.
-        predictions = sorted(prelim_predictions, key=lambda x: x["score"], reverse=True)[:n_best_size]
-
-        # Add back the minimum null prediction if it was removed because of its low score.
-        if (
-            version_2_with_negative
-            and min_null_prediction is not None
-            and not any(p["offsets"] == (0, 0) for p in predictions)
-        ):
-            predictions.append(min_null_prediction)
-
-        # Use the offsets to gather the answer text in the original context.
-        context = example["context"]
-        for pred in predictions:
-            offsets = pred.pop("offsets")
-            pred["text"] = context[offsets[0] : offsets[1]]
-
-        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
-        # failure.
-        if len(predictions) == 0 or (len(predictions) == 1 and predictions[0]["text"] == ""):
-            predictions.insert(0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0})
-
-        # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
-        # the LogSumExp trick).
-        scores = np.array([pred.pop("score") for pred in predictions])
-        exp_scores = np.exp(scores - np.max(scores))
-        probs = exp_scores / exp_scores.sum()
-
-        # Include the probabilities in our predictions.
-        for prob, pred in zip(probs, predictions):
-            pred["probability"] = prob
-
-        # Pick the best prediction. If the null answer is not possible, this is easy.
+    scores_diff_json = collections.OrderedDict()
+    contexts = column_values(examples, "context")
+    best_by_example = {
+        example: (feature, null_score)
+        for example, feature, null_score in zip(grouped_examples.tolist(), best_feature.tolist(), min_null_scores.tolist())
+    }
+    for example_index, example_id in enumerate(example_ids):
+        if example_index not in best_by_example:
+            all_predictions[example_id] = ""
+            continue
+        feature, null_score = best_by_example[example_index]
+        if np.isfinite(best_scores[feature]):
+            text = contexts[example_index][
+                token_starts[feature, best_starts[feature]]:token_ends[feature, best_ends[feature]]
+            ]
+            best_score = float(start_logits[feature, best_starts[feature]] + end_logits[feature, best_ends[feature]])
+        else:
+            # no valid span in any feature: same placeholder answer as the reference implementation
+            text = "empty"
+            best_score = 0.0
+
         if not version_2_with_negative:
-            all_predictions[example["id"]] = predictions[0]["text"]
+            all_predictions[example_id] = text
         else:
-            # Otherwise we first need to find the best non-empty prediction.
-            i = 0
-            while predictions[i]["text"] == "":
-                i += 1
-            best_non_null_pred = predictions[i]
-
-            # Then we compare to the null prediction using the threshold.
-            score_diff = null_score - best_non_null_pred["start_logit"] - best_non_null_pred["end_logit"]
-            scores_diff_json[example["id"]] = float(score_diff)  # To be JSON-serializable.
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example["id"]] = ""
-            else:
-                all_predictions[example["id"]] = best_non_null_pred["text"]
-
-        # Make `predictions` JSON-serializable by casting np.float back to float.
-        all_nbest_json[example["id"]] = [
-            {k: (float(v) if isinstance(v, (np.float16, np.float32, np.float64)) else v) for k, v in pred.items()}
-            for pred in predictions
-        ]
-
-    return all_predictions
+            score_diff = null_score - best_score
+            scores_diff_json[example_id] = float(score_diff)
+            all_predictions[example_id] = "" if score_diff > null_score_diff_threshold else text
+
+    return all_predictions, scores_diff_json
 
 """
         if data_args.version_2_with_negative:
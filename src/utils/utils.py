@@ -17,6 +17,7 @@ def register_to(registry):
     def register_to_inner(class_obj):
         nonlocal registry
         register_classes(class_obj, registry)
+        return class_obj
     return register_to_inner
 
 def make_registry_entry():